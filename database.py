@@ -1,24 +1,187 @@
-from pymongo import MongoClient, ASCENDING, DESCENDING
+from pymongo import MongoClient, InsertOne, UpdateOne, IndexModel, WriteConcern, ASCENDING, DESCENDING
 from pymongo.collection import Collection
 from pymongo.database import Database
-from datetime import datetime
-from typing import Optional, Dict, List
-import hashlib
+from pymongo.errors import BulkWriteError
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Iterable, Iterator, List, Tuple
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import singledispatch
+from itertools import islice
 import os
-from models import ItemType, ListingPreview, ItemPreview
+import xxhash
+from models import (
+    ItemType, ListingPreview, ItemPreview,
+    GunPreview, MagazinePreview, AmmunitionPreview
+)
+
+# Maximum number of operations sent in a single bulk_write call
+BULK_WRITE_BATCH_SIZE = 1000
+
+# MongoDB duplicate key error code
+DUPLICATE_KEY_ERROR = 11000
+
+# save_listings prepares and writes listings in chunks across a thread pool
+SAVE_LISTINGS_CHUNK_SIZE = 500
+SAVE_LISTINGS_WORKERS = 8
+
+# Algorithm used for item hashes, stored alongside hashed documents so
+# rows written with an older algorithm (md5) can be told apart
+HASH_ALGO = "xxh3_128"
+
+# Multikey/analytics indexes on listings. No read path needs them while
+# scraping, so they are only built on demand by create_analytics_indexes()
+# instead of being maintained on every listing write.
+LISTING_ANALYTICS_INDEXES = [
+    IndexModel("items.manufacturer"),
+    IndexModel("items.model"),
+    IndexModel("items.item_type"),
+    IndexModel("price"),
+]
+
+# Fields returned by default from market price and session lookups
+MARKET_PRICE_PROJECTION = {"_id": 0, "item_hash": 1, "item_type": 1, "price": 1, "last_updated": 1}
+SESSION_SUMMARY_PROJECTION = {"_id": 1, "root_url": 1, "start_time": 1, "status": 1}
+
+# Shared MongoClients, keyed by connection URI (None for the MONGODB_HOST settings)
+_clients: Dict[Optional[str], MongoClient] = {}
+
+def _get_client(uri: Optional[str] = None) -> MongoClient:
+    """
+    Get the shared MongoClient, creating it on first use
+    
+    Args:
+        uri: Connection string to use instead of the MONGODB_HOST/PORT/USERNAME
+            settings; each URI gets its own shared client
+    """
+    client = _clients.get(uri)
+    if client is None:
+        connection = {"host": uri} if uri else {
+            "host": os.getenv("MONGODB_HOST", "localhost"),
+            "port": int(os.getenv("MONGODB_PORT", 27017)),
+            "username": os.getenv("MONGODB_USERNAME"),
+            "password": os.getenv("MONGODB_PASSWORD"),
+            "authSource": os.getenv("MONGODB_AUTH_DB", "admin"),
+        }
+        client = _clients[uri] = MongoClient(
+            **connection,
+            maxPoolSize=50,
+            minPoolSize=5,
+            maxIdleTimeMS=60000,
+            compressors="zstd,zlib",  # Listing documents are mostly text and compress well
+            retryWrites=True,
+            w=1
+        )
+    return client
+
+def close_clients():
+    """Close every shared MongoClient, once when a script exits"""
+    # MongoManagers share their client, so closing one of them would break the rest
+    while _clients:
+        _clients.popitem()[1].close()
+
+def _norm(value: Optional[str]) -> str:
+    """Normalize a string field for hashing"""
+    return (value or "").lower().strip()
+
+def _default_hash_key(type_tag: str, item: dict) -> tuple:
+    return (type_tag, _norm(item.get("manufacturer")), _norm(item.get("model")), "")
+
+def _caliber_hash_key(type_tag: str, item: dict) -> tuple:
+    return (
+        type_tag,
+        _norm(item.get("manufacturer")),
+        _norm(item.get("model")),
+        _norm(item.get("caliber"))
+    )
+
+def _magazine_hash_key(type_tag: str, item: dict) -> tuple:
+    return (
+        type_tag,
+        _norm(item.get("manufacturer")),
+        _norm(item.get("model")),
+        _norm(item.get("caliber")),
+        str(item.get("capacity") or "")
+    )
+
+# Item hash key builders by item type value, joined with "|" before hashing
+_HASH_KEY_BUILDERS = {
+    ItemType.GUN.value: _caliber_hash_key,
+    ItemType.MAGAZINE.value: _magazine_hash_key,
+    ItemType.AMMUNITION.value: _caliber_hash_key,
+}
+
+def _type_tag(item_type) -> str:
+    """Get the plain string value of an item type"""
+    return getattr(item_type, "value", item_type) or ""
+
+@singledispatch
+def _item_hash_key(item: ItemPreview) -> tuple:
+    """Get the hash key fields for an item model, dispatched on its class"""
+    type_tag = _type_tag(item.item_type)
+    return _HASH_KEY_BUILDERS.get(type_tag, _default_hash_key)(type_tag, item.model_dump())
+
+@_item_hash_key.register
+def _(item: GunPreview) -> tuple:
+    return _caliber_hash_key(_type_tag(item.item_type), item.model_dump())
+
+@_item_hash_key.register
+def _(item: AmmunitionPreview) -> tuple:
+    return _caliber_hash_key(_type_tag(item.item_type), item.model_dump())
+
+@_item_hash_key.register
+def _(item: MagazinePreview) -> tuple:
+    return _magazine_hash_key(_type_tag(item.item_type), item.model_dump())
+
+# Hashers already fed the "<item_type>|" prefix every key starts with
+_PRIMED_HASHERS = {t.value: xxhash.xxh3_128(f"{t.value}|".encode()) for t in ItemType}
+
+def _digest_hash_key(key: tuple) -> bytes:
+    """Hash the joined key fields into a raw 16 byte digest (stored as BSON binary)"""
+    primed = _PRIMED_HASHERS.get(key[0])
+    if primed is None:
+        return xxhash.xxh3_128("|".join(key).encode()).digest()
+    hasher = primed.copy()
+    hasher.update("|".join(key[1:]).encode())
+    return hasher.digest()
+
+def _chunked(items: Iterable, size: int) -> Iterator[list]:
+    """Yield successive lists of at most size items"""
+    it = iter(items)
+    while chunk := list(islice(it, size)):
+        yield chunk
+
+class BulkWriter:
+    """Queues write operations for a collection and sends them with bulk_write"""
+    
+    def __init__(self, collection: Collection, batch_size: int = BULK_WRITE_BATCH_SIZE):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.ops: List[UpdateOne] = []
+    
+    def add(self, op: UpdateOne):
+        """Queue an operation, flushing once a full batch is queued"""
+        self.ops.append(op)
+        if len(self.ops) >= self.batch_size:
+            self.flush()
+    
+    def flush(self):
+        """Send all queued operations in a single unordered bulk_write"""
+        if self.ops:
+            ops, self.ops = self.ops, []
+            self.collection.bulk_write(ops, ordered=False)
 
 class MongoManager:
     """Unified MongoDB manager for marketplace data"""
     
-    def __init__(self):
-        # Load MongoDB configuration from environment
-        self.client = MongoClient(
-            host=os.getenv("MONGODB_HOST", "localhost"),
-            port=int(os.getenv("MONGODB_PORT", 27017)),
-            username=os.getenv("MONGODB_USERNAME"),
-            password=os.getenv("MONGODB_PASSWORD"),
-            authSource=os.getenv("MONGODB_AUTH_DB", "admin")
-        )
+    def __init__(self, fast_insert: bool = True):
+        """
+        Args:
+            fast_insert: Write listings with an unacknowledged (w=0) write
+                concern. Listings are re-scraped and re-saved idempotently,
+                so losing an ack is acceptable there.
+        """
+        self.client = _get_client()
         self.db_name = os.getenv("MONGODB_DB_NAME", "gun_market_data")
         self.db: Database = self.client[self.db_name]
         
@@ -29,6 +192,12 @@ class MongoManager:
         self.market_prices: Collection = self.db.market_prices
         self.price_analyses: Collection = self.db.price_analyses
         
+        # Collection handle used for listing writes
+        self.listings_writer: Collection = (
+            self.db.get_collection("listings", write_concern=WriteConcern(w=0))
+            if fast_insert else self.listings
+        )
+        
         # Setup indexes
         self._setup_indexes()
     
@@ -41,21 +210,26 @@ class MongoManager:
         ])
         
         # Listings indexes
-        self.listings.create_index([
-            ("session_id", ASCENDING),
-            ("listing_url", ASCENDING)
-        ], unique=True)
-        self.listings.create_index("items.manufacturer")
-        self.listings.create_index("items.model")
-        self.listings.create_index("items.item_type")
-        self.listings.create_index("price")
+        self.listings.create_indexes([
+            IndexModel([
+                ("session_id", ASCENDING),
+                ("listing_url", ASCENDING)
+            ], unique=True),
+            # Serves normalize.py's unnormalized-listings scan in _id order
+            IndexModel([
+                ("normalized_at", ASCENDING),
+                ("_id", ASCENDING)
+            ])
+        ])
         
         # Market prices indexes
-        self.market_prices.create_index([
-            ("item_hash", ASCENDING),
-            ("item_type", ASCENDING)
-        ], unique=True)
-        self.market_prices.create_index("last_updated")
+        self.market_prices.create_indexes([
+            IndexModel([
+                ("item_hash", ASCENDING),
+                ("item_type", ASCENDING)
+            ], unique=True),
+            IndexModel("last_updated")
+        ])
         
         # Price analyses indexes
         self.price_analyses.create_index([
@@ -70,28 +244,43 @@ class MongoManager:
             ("type", ASCENDING)
         ])
 
-    def generate_item_hash(self, item: ItemPreview) -> str:
+    def create_analytics_indexes(self):
+        """Build the listing analytics indexes, e.g. once a scrape session is saved"""
+        self.listings.create_indexes(LISTING_ANALYTICS_INDEXES)
+
+    def drop_analytics_indexes(self):
+        """Drop the listing analytics indexes so listing writes stay cheap"""
+        existing = self.listings.index_information()
+        for index in LISTING_ANALYTICS_INDEXES:
+            name = index.document["name"]
+            if name in existing:
+                self.listings.drop_index(name)
+
+    def generate_item_hash(self, item: ItemPreview) -> bytes:
         """Generate a unique hash for an item"""
-        # Normalize strings
-        manufacturer = item.manufacturer.lower().strip() if item.manufacturer else ""
-        model = item.model.lower().strip() if item.model else ""
-        
-        # Add type-specific fields to hash
-        extra_fields = []
-        if item.item_type == ItemType.GUN:
-            caliber = item.caliber.lower().strip() if item.caliber else ""
-            extra_fields.append(caliber)
-        elif item.item_type == ItemType.MAGAZINE:
-            caliber = item.caliber.lower().strip() if item.caliber else ""
-            capacity = str(item.capacity) if item.capacity else ""
-            extra_fields.extend([caliber, capacity])
-        elif item.item_type == ItemType.AMMUNITION:
-            caliber = item.caliber.lower().strip() if item.caliber else ""
-            extra_fields.append(caliber)
-        
-        # Create hash
-        hash_string = f"{item.item_type}|{manufacturer}|{model}|{'|'.join(extra_fields)}"
-        return hashlib.md5(hash_string.encode()).hexdigest()
+        return _digest_hash_key(_item_hash_key(item))
+
+    def _hash_item_dict(self, item: dict, cache: Optional[Dict[tuple, bytes]] = None) -> bytes:
+        """
+        Generate a unique hash for an item given as a plain dict
+        
+        Args:
+            item: Item fields, as produced by ItemPreview.model_dump()
+            cache: Optional dict of already computed hashes keyed by the
+                normalized item fields. Not thread-safe, use one per thread.
+        """
+        type_tag = _type_tag(item.get("item_type"))
+        key = _HASH_KEY_BUILDERS.get(type_tag, _default_hash_key)(type_tag, item)
+        
+        if cache is None:
+            return _digest_hash_key(key)
+        
+        # Identical items repeat across listings, only hash each one once
+        item_hash = cache.get(key)
+        if item_hash is None:
+            item_hash = _digest_hash_key(key)
+            cache[key] = item_hash
+        return item_hash
 
     def save_scraping_session(self, data: dict) -> str:
         """Save a new scraping session and return its ID"""
@@ -106,34 +295,96 @@ class MongoManager:
         
         return str(self.scraping_sessions.insert_one(session).inserted_id)
 
-    def save_listings(self, session_id: str, listings: List[ListingPreview]):
-        """Save listings from a scraping session"""
+    def _bulk_write(self, collection: Collection, ops: List, skip_duplicates: bool = False):
+        """
+        Send operations to a collection in unordered bulk_write batches
+        
+        With skip_duplicates, inserts rejected by a unique index are ignored
+        (unacknowledged writes never report them in the first place).
+        """
+        # bypass_document_validation is rejected for unacknowledged writes
+        bypass_validation = collection.write_concern.acknowledged
+        for i in range(0, len(ops), BULK_WRITE_BATCH_SIZE):
+            try:
+                collection.bulk_write(
+                    ops[i:i + BULK_WRITE_BATCH_SIZE],
+                    ordered=False,
+                    bypass_document_validation=bypass_validation
+                )
+            except BulkWriteError as e:
+                details = e.details
+                if not skip_duplicates or details.get("writeConcernErrors") or any(
+                    error["code"] != DUPLICATE_KEY_ERROR for error in details.get("writeErrors", [])
+                ):
+                    raise
+
+    def _prepare_and_write_chunk(self, session_id: str, listings: List[ListingPreview], new_session: bool):
+        """Build and write the inserts or upserts for one chunk of listings"""
+        hash_cache: Dict[tuple, bytes] = {}
+        ops = []
         for listing in listings:
             listing_dict = listing.model_dump()
             listing_dict["session_id"] = session_id
+            listing_dict["hash_algo"] = HASH_ALGO
             
             # Generate hashes for all items
             for item in listing_dict["items"]:
-                item["item_hash"] = self.generate_item_hash(ItemPreview(**item))
+                item["item_hash"] = self._hash_item_dict(item, hash_cache)
             
-            self.listings.update_one(
-                {
-                    "session_id": session_id,
-                    "listing_url": listing_dict["listing_url"]
-                },
-                {"$set": listing_dict},
-                upsert=True
-            )
+            if new_session:
+                ops.append(InsertOne(listing_dict))
+            else:
+                ops.append(UpdateOne(
+                    {
+                        "session_id": session_id,
+                        "listing_url": listing_dict["listing_url"]
+                    },
+                    {"$set": listing_dict},
+                    upsert=True
+                ))
+        
+        # A listing repeated within the session hits the unique
+        # (session_id, listing_url) index and is skipped
+        self._bulk_write(self.listings_writer, ops, skip_duplicates=new_session)
 
-    def _ensure_string_keys(self, data: Dict) -> Dict:
-        """Recursively convert all dictionary keys to strings"""
-        if not isinstance(data, dict):
-            return data
+    def save_listings(self, session_id: str, listings: Iterable[ListingPreview], new_session: bool = False):
+        """
+        Save listings from a scraping session
         
-        return {
-            str(key): self._ensure_string_keys(value) if isinstance(value, dict) else value
-            for key, value in data.items()
-        }
+        listings may be any iterable, e.g. ListingsPages.iter_listings().
+        At most one chunk per worker is held in memory at a time.
+        
+        Pass new_session=True when the session was just created and holds no
+        listings yet; plain inserts are then used instead of upserts.
+        """
+        with ThreadPoolExecutor(max_workers=SAVE_LISTINGS_WORKERS) as executor:
+            pending = set()
+            for chunk in _chunked(listings, SAVE_LISTINGS_CHUNK_SIZE):
+                if len(pending) >= SAVE_LISTINGS_WORKERS:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    # Surface any write errors from the workers
+                    for future in done:
+                        future.result()
+                pending.add(executor.submit(self._prepare_and_write_chunk, session_id, chunk, new_session))
+            for future in pending:
+                future.result()
+
+    def _ensure_string_keys(self, data: Dict) -> Dict:
+        """Convert all dictionary keys to strings, in place"""
+        stack = [data]
+        while stack:
+            d = stack.pop()
+            if not isinstance(d, dict):
+                continue
+            # Only rewrite the keys that actually need it
+            for key in [k for k in d if not isinstance(k, str)]:
+                d[str(key)] = d.pop(key)
+            for value in d.values():
+                if isinstance(value, dict):
+                    stack.append(value)
+                elif isinstance(value, list):
+                    stack.extend(v for v in value if isinstance(v, dict))
+        return data
 
     def save_statistics(self, session_id: str, stats: Dict):
         """Save analysis statistics for a session"""
@@ -143,60 +394,225 @@ class MongoManager:
         stats = self._ensure_string_keys(stats)
         self.statistics.insert_one(stats)
 
-    def get_market_price(self, item_hash: str, item_type: ItemType, max_age_days: int = 7) -> Optional[dict]:
-        """Get existing market price data if not too old"""
-        price_data = self.market_prices.find_one({
+    def get_market_price(
+        self,
+        item_hash: bytes,
+        item_type: ItemType,
+        max_age_days: int = 7,
+        projection: Optional[dict] = MARKET_PRICE_PROJECTION
+    ) -> Optional[dict]:
+        """Get existing market price data if not too old
+
+        Only the fields in MARKET_PRICE_PROJECTION are returned unless a
+        different projection is given; pass projection=None for the full
+        document.
+        """
+        return self.market_prices.find_one({
             "item_hash": item_hash,
-            "item_type": item_type
-        })
-        if price_data:
-            last_updated = datetime.fromisoformat(price_data["last_updated"])
-            if (datetime.now() - last_updated).days < max_age_days:
-                return price_data
-        return None
+            "item_type": item_type,
+            "last_updated": {"$gte": datetime.utcnow() - timedelta(days=max_age_days)}
+        }, projection=projection)
 
-    def save_market_price(self, price_data: dict):
-        """Save or update market price data"""
-        self.market_prices.update_one(
+    def get_market_prices_batch(
+        self,
+        item_hashes: List[bytes],
+        max_age_days: int = 7,
+        projection: Optional[dict] = MARKET_PRICE_PROJECTION
+    ) -> Dict[bytes, dict]:
+        """Get fresh market price data for many items in one query, keyed by item hash"""
+        if not item_hashes:
+            return {}
+        cursor = self.market_prices.find({
+            "item_hash": {"$in": list(item_hashes)},
+            "last_updated": {"$gte": datetime.utcnow() - timedelta(days=max_age_days)}
+        }, projection=projection)
+        return {doc["item_hash"]: doc for doc in cursor}
+
+    def _market_price_op(self, price_data: dict) -> UpdateOne:
+        """Build the upsert operation for a market price document"""
+        last_updated = price_data.get("last_updated")
+        if not isinstance(last_updated, datetime):
+            last_updated = datetime.utcnow()
+        return UpdateOne(
             {
                 "item_hash": price_data["item_hash"],
                 "item_type": price_data["item_type"]
             },
-            {"$set": price_data},
+            {"$set": {**price_data, "hash_algo": HASH_ALGO, "last_updated": last_updated}},
             upsert=True
         )
 
-    def save_price_analysis(self, analysis: dict):
-        """Save price analysis results"""
-        self.price_analyses.update_one(
+    def _price_analysis_op(self, analysis: dict) -> UpdateOne:
+        """Build the upsert operation for a price analysis document"""
+        return UpdateOne(
             {
                 "item_hash": analysis["item_hash"],
                 "item_type": analysis["item_type"],
                 "listing_url": analysis["listing_url"]
             },
-            {"$set": analysis},
+            {"$set": {**analysis, "hash_algo": HASH_ALGO}},
             upsert=True
         )
 
+    def save_market_price(self, price_data: dict):
+        """Save or update market price data"""
+        self.save_market_prices([price_data])
+
+    def save_market_prices(self, prices: List[dict]):
+        """Save or update market price data for many items at once"""
+        self._bulk_write(self.market_prices, [self._market_price_op(p) for p in prices])
+
+    def save_price_analysis(self, analysis: dict):
+        """Save price analysis results"""
+        self.save_price_analyses([analysis])
+
+    def save_price_analyses(self, analyses: List[dict]):
+        """Save many price analysis results at once"""
+        self._bulk_write(self.price_analyses, [self._price_analysis_op(a) for a in analyses])
+
+    def aggregate_session_stats(self, session_id: str) -> Dict:
+        """Compute the raw listing statistics for a session server-side in one $facet pass"""
+        priced = {"$match": {"price": {"$gt": 0}}}
+        num_guns = {"$size": {"$ifNull": ["$guns", []]}}
+        
+        def top_values(field: str, limit: Optional[int] = 10) -> List[Dict]:
+            stages = [
+                {"$unwind": "$guns"},
+                {"$match": {f"guns.{field}": {"$nin": ["NA", None]}}},
+                {"$sortByCount": f"$guns.{field}"}
+            ]
+            return stages + [{"$limit": limit}] if limit else stages
+        
+        def distribution(size_expr: Dict) -> List[Dict]:
+            return [
+                {"$group": {"_id": size_expr, "count": {"$sum": 1}}},
+                {"$sort": {"count": -1}}
+            ]
+        
+        facets = self.listings.aggregate([
+            {"$match": {"session_id": session_id}},
+            {"$facet": {
+                "price": [priced, {"$group": {
+                    "_id": None,
+                    "count": {"$sum": 1},
+                    "mean": {"$avg": "$price"},
+                    "median": {"$median": {"input": "$price", "method": "approximate"}},
+                    "std_dev": {"$stdDevSamp": "$price"},
+                    "min": {"$min": "$price"},
+                    "max": {"$max": "$price"}
+                }}],
+                # Upper bounds are inclusive, which $bucket can't express
+                "price_ranges": [priced, {"$group": {
+                    "_id": {"$switch": {
+                        "branches": [
+                            {"case": {"$lte": ["$price", 500]}, "then": "0-500"},
+                            {"case": {"$lte": ["$price", 1000]}, "then": "501-1000"},
+                            {"case": {"$lte": ["$price", 2000]}, "then": "1001-2000"}
+                        ],
+                        "default": "2001+"
+                    }},
+                    "count": {"$sum": 1}
+                }}],
+                "manufacturers": top_values("manufacturer"),
+                "models": top_values("model"),
+                "calibers": top_values("caliber"),
+                "conditions": top_values("condition", limit=None),
+                "totals": [{"$group": {
+                    "_id": None,
+                    "total_listings": {"$sum": 1},
+                    "listings_with_guns": {"$sum": {"$cond": [{"$gt": [num_guns, 0]}, 1, 0]}}
+                }}],
+                "guns_per_listing": distribution(num_guns),
+                "images_per_listing": distribution({"$size": {"$ifNull": ["$image_urls", []]}})
+            }}
+        ])
+        return next(facets)
+
     def get_session_listings(self, session_id: str):
         """Get all listings for a specific session"""
         return self.listings.find({"session_id": session_id})
 
-    def get_latest_session(self, root_url: Optional[str] = None):
-        """Get the most recent scraping session, optionally filtered by URL"""
+    def get_latest_session(self, root_url: Optional[str] = None, projection: Optional[dict] = None):
+        """Get the most recent scraping session, optionally filtered by URL
+
+        Pass projection=SESSION_SUMMARY_PROJECTION when the execution info
+        and other bulky fields are not needed.
+        """
         query = {"root_url": root_url} if root_url else {}
         return self.scraping_sessions.find_one(
             query,
+            projection=projection,
             sort=[("start_time", DESCENDING)]
         )
 
-    def get_item_analyses(self, item_hash: str, item_type: ItemType):
+    def get_item_analyses(self, item_hash: bytes, item_type: ItemType):
         """Get all price analyses for a specific item"""
         return self.price_analyses.find({
             "item_hash": item_hash,
             "item_type": item_type
         })
 
-    def close(self):
-        """Close the MongoDB connection"""
-        self.client.close() 
\ No newline at end of file
+    def get_item_analyses_batch(self, items: List[Tuple[bytes, ItemType]]):
+        """Get all price analyses for many (item_hash, item_type) pairs in one query"""
+        hashes_by_type = defaultdict(list)
+        for item_hash, item_type in items:
+            hashes_by_type[item_type].append(item_hash)
+        if not hashes_by_type:
+            return []
+        return self.price_analyses.find({"$or": [
+            {"item_type": item_type, "item_hash": {"$in": hashes}}
+            for item_type, hashes in hashes_by_type.items()
+        ]})
+
+    def drop_market_price_freshness_index(self):
+        """Drop the (item_hash, item_type, last_updated) index older versions built"""
+        # The unique (item_hash, item_type) index already narrows lookups to one row
+        name = "item_hash_1_item_type_1_last_updated_-1"
+        if name in self.market_prices.index_information():
+            self.market_prices.drop_index(name)
+
+    def migrate_last_updated_dates(self, timezone: Optional[str] = None) -> int:
+        """
+        Convert market prices whose last_updated is an ISO string to BSON dates
+        
+        Args:
+            timezone: Timezone the old strings were written in, as an Olson
+                name or UTC offset. They came from naive datetime.now(), so this
+                defaults to the current UTC offset of this machine, which is
+                off by the DST shift for strings from the other half of the year.
+        """
+        if timezone is None:
+            timezone = datetime.now().astimezone().strftime("%z")
+        result = self.market_prices.update_many(
+            {"last_updated": {"$type": "string"}},
+            [{"$set": {"last_updated": {"$dateFromString": {
+                "dateString": "$last_updated",
+                "timezone": timezone
+            }}}}]
+        )
+        return result.modified_count
+
+    def migrate_listing_item_hashes(self) -> int:
+        """
+        Rehash the items of listings saved before the current HASH_ALGO
+
+        Old md5 hashes can't be converted to xxh3, so they are recomputed from
+        the item fields. Market prices and price analyses under the old hashes
+        are left alone; they stop matching lookups and get re-populated.
+        """
+        hash_cache = {}
+        writer = BulkWriter(self.listings)
+        rehashed = 0
+        for doc in self.listings.find(
+            {"hash_algo": {"$ne": HASH_ALGO}, "items.0": {"$exists": True}},
+            projection={"items": 1}
+        ):
+            for item in doc["items"]:
+                item["item_hash"] = self._hash_item_dict(item, hash_cache)
+            writer.add(UpdateOne(
+                {"_id": doc["_id"]},
+                {"$set": {"items": doc["items"], "hash_algo": HASH_ALGO}}
+            ))
+            rehashed += 1
+        writer.flush()
+        return rehashed
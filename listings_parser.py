@@ -0,0 +1,64 @@
+import re
+from typing import Optional
+from urllib.parse import urljoin
+from selectolax.lexbor import LexborHTMLParser, LexborNode
+from models import ListingPreview, ListingPreviews
+
+# CSS selectors for the listing previews on texasguntrader.com category pages
+LISTING_SELECTOR = "div.listing"
+TITLE_SELECTOR = ".listing-title a"
+PRICE_SELECTOR = ".listing-price"
+DESCRIPTION_SELECTOR = ".listing-description"
+IMAGE_SELECTOR = "img"
+
+PRICE_PATTERN = re.compile(r"\d[\d,]*(?:\.\d+)?")
+
+class ListingParseError(Exception):
+    """The page doesn't have the expected markup, so it needs the LLM scraper"""
+
+def _text(node: LexborNode, selector: str) -> Optional[str]:
+    """Stripped text of the first match of selector under node, if any"""
+    match = node.css_first(selector)
+    return match.text(strip=True) if match else None
+
+def _price(text: Optional[str]) -> float:
+    """Parse a displayed price, treating a missing one ("make offer") as 0"""
+    match = PRICE_PATTERN.search(text or "")
+    return float(match.group().replace(",", "")) if match else 0.0
+
+def has_listings_markup(html: str) -> bool:
+    """Whether the page has any element parse_listings would read as a listing"""
+    return LexborHTMLParser(html).css_first(LISTING_SELECTOR) is not None
+
+def parse_listings(html: str, page_url: str) -> ListingPreviews:
+    """
+    Extract the listing previews of a category page from its markup
+
+    Items are left empty; scrape.py extracts them from the title and
+    description with the LLM afterwards.
+
+    Raises:
+        ListingParseError: If the page has no listings in the expected markup
+    """
+    listings = []
+    for node in LexborHTMLParser(html).css(LISTING_SELECTOR):
+        link = node.css_first(TITLE_SELECTOR)
+        href = link.attributes.get("href") if link else None
+        if not href:
+            raise ListingParseError(f"Listing without a title link on {page_url}")
+
+        listings.append(ListingPreview(
+            title=link.text(strip=True),
+            price=_price(_text(node, PRICE_SELECTOR)),
+            description=_text(node, DESCRIPTION_SELECTOR) or "",
+            listing_url=urljoin(page_url, href),
+            image_urls=[
+                urljoin(page_url, img.attributes["src"])
+                for img in node.css(IMAGE_SELECTOR)
+                if img.attributes.get("src")
+            ]
+        ))
+
+    if not listings:
+        raise ListingParseError(f"No listings found in the markup of {page_url}")
+    return ListingPreviews(listings=listings)
@@ -0,0 +1,57 @@
+import fcntl
+import hashlib
+import json
+import sqlite3
+import time
+from contextlib import closing, contextmanager
+from pathlib import Path
+from typing import Any, Iterator, Optional
+
+CACHE_PATH = Path("llm_cache.sqlite3")  # Where scraped LLM results are kept between runs
+DEFAULT_TTL = 7 * 24 * 60 * 60  # Cached results expire after a week
+
+def cache_key(*parts: str) -> str:
+    """Build a cache key from everything that determines an LLM result"""
+    return hashlib.sha256("|".join(parts).encode()).hexdigest()
+
+class DiskCache:
+    """JSON values stored in SQLite, each expiring after its TTL"""
+
+    def __init__(self, path: Path = CACHE_PATH):
+        self.path = path
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        # A connection per call keeps the cache safe to use from scraper threads
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, key: str) -> Optional[Any]:
+        """Get a cached value, or None if it is missing or expired"""
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT value FROM cache WHERE key = ? AND expires_at > ?",
+                (key, time.time())
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key: str, value: Any, ttl: float = DEFAULT_TTL):
+        """Cache a JSON-serializable value for ttl seconds"""
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), time.time() + ttl)
+            )
+
+    @contextmanager
+    def lock(self) -> Iterator[None]:
+        """Hold an exclusive lock shared by every process using this cache"""
+        with open(self.path.with_name(self.path.name + ".lock"), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
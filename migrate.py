@@ -0,0 +1,34 @@
+import argparse
+from typing import Optional
+from dotenv import load_dotenv
+from database import MongoManager, close_clients
+
+def main(timezone: Optional[str] = None):
+    """One-off migrations for data written by older versions"""
+    load_dotenv()
+    db = MongoManager()
+    
+    try:
+        converted = db.migrate_last_updated_dates(timezone)
+        print(f"Converted last_updated to a date on {converted} market prices")
+        
+        rehashed = db.migrate_listing_item_hashes()
+        print(f"Rehashed the items of {rehashed} listings")
+        
+        # Older versions built the analytics indexes on every start
+        db.drop_analytics_indexes()
+        print("Dropped the listing analytics indexes")
+        
+        db.drop_market_price_freshness_index()
+        print("Dropped the redundant market price freshness index")
+    finally:
+        close_clients()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate data written by older versions")
+    parser.add_argument(
+        "--timezone",
+        help="Timezone old last_updated strings were written in (default: this machine's current UTC offset)"
+    )
+    args = parser.parse_args()
+    main(timezone=args.timezone)
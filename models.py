@@ -1,5 +1,5 @@
-from pydantic import BaseModel, Field
-from typing import List, Optional
+from pydantic import BaseModel, ConfigDict, Field, SerializeAsAny, field_validator, model_validator
+from typing import Iterator, List, Optional
 from enum import Enum
 
 class Condition(str, Enum):
@@ -81,8 +81,13 @@ class Listing(BaseModel):
 class Listings(BaseModel):
     listings: List[Listing] = Field(description="List of all listings found on the page")
 
+# Preview models are created in bulk while scraping and never mutated
+PREVIEW_MODEL_CONFIG = ConfigDict(extra="ignore", frozen=True, use_enum_values=True)
+
 class ItemPreview(BaseModel):
     """Base preview model for any item type"""
+    model_config = PREVIEW_MODEL_CONFIG
+    
     item_type: ItemType
     manufacturer: Optional[str] = None
     model: Optional[str] = None
@@ -106,13 +111,36 @@ class AmmunitionPreview(ItemPreview):
     caliber: Optional[str] = None
     quantity: Optional[int] = None
 
+# Concrete preview class for each item type, other types use ItemPreview
+ITEM_PREVIEW_TYPES = {
+    ItemType.GUN.value: GunPreview,
+    ItemType.MAGAZINE.value: MagazinePreview,
+    ItemType.AMMUNITION.value: AmmunitionPreview,
+}
+
+def item_preview_from_dict(data: dict) -> ItemPreview:
+    """Build the concrete preview model matching the item's item_type"""
+    item_type = data.get("item_type")
+    preview_type = ITEM_PREVIEW_TYPES.get(getattr(item_type, "value", item_type), ItemPreview)
+    return preview_type.model_validate(data)
+
+def concrete_item_previews(items):
+    """Validate item dicts as the concrete preview class of their item_type"""
+    # Keeps type-specific fields such as caliber instead of validating every
+    # item as the base ItemPreview
+    if not isinstance(items, list):
+        return items
+    return [item_preview_from_dict(item) if isinstance(item, dict) else item for item in items]
+
 class ListingPreview(BaseModel):
+    model_config = PREVIEW_MODEL_CONFIG
+    
     title: str = Field(description="The title of the listing")
     price: float = Field(description="The total price of the listing")
     description: str = Field(description="The preview description from the listing")
     
     # Preview items (can be any type)
-    items: List[ItemPreview] = Field(
+    items: List[SerializeAsAny[ItemPreview]] = Field(
         default_factory=list,
         description="List of items identified in the preview"
     )
@@ -126,16 +154,47 @@ class ListingPreview(BaseModel):
     listing_url: str = Field(description="URL of the detailed listing")
     image_urls: List[str] = Field(default_factory=list)
 
-    def __init__(self, **data):
-        super().__init__(**data)
+    @field_validator("items", mode="before")
+    @classmethod
+    def _concrete_items(cls, items):
+        return concrete_item_previews(items)
+
+    @model_validator(mode="before")
+    @classmethod
+    def _migrate_guns(cls, data):
         # Convert legacy guns to items if present
-        if self.guns and not self.items:
-            self.items = [gun for gun in self.guns]
-            self.guns = None
+        if isinstance(data, dict) and data.get("guns") and not data.get("items"):
+            data = {
+                **data,
+                "items": [
+                    GunPreview.model_validate(gun) if isinstance(gun, dict) else gun
+                    for gun in data["guns"]
+                ],
+                "guns": None
+            }
+        return data
 
 class ListingPreviews(BaseModel):
+    model_config = PREVIEW_MODEL_CONFIG
+    
     listings: List[ListingPreview] = Field(description="List of all listing previews found on the page")
 
+class ListingItems(BaseModel):
+    """Items of a listing whose other fields were parsed from the page markup"""
+    listing_url: str = Field(description="URL of the listing, exactly as given")
+    items: List[SerializeAsAny[ItemPreview]] = Field(
+        default_factory=list,
+        description="List of items identified in the listing"
+    )
+
+    @field_validator("items", mode="before")
+    @classmethod
+    def _concrete_items(cls, items):
+        return concrete_item_previews(items)
+
+class ListingsItems(BaseModel):
+    listings: List[ListingItems] = Field(description="Items of each listing")
+
 class ListingsPage(BaseModel):
     page_url: str = Field(description="URL of the page")
     page_number: int = Field(description="Page number of the page")
@@ -148,9 +207,10 @@ class ListingsPages(BaseModel):
     @property
     def all_listings(self) -> List[ListingPreview]:
         """Get all listing previews from all pages in a single flat list"""
-        return [
-            preview 
-            for page in self.pages 
-            if page.listing_previews 
-            for preview in page.listing_previews.listings
-        ]
+        return list(self.iter_listings())
+
+    def iter_listings(self) -> Iterator[ListingPreview]:
+        """Iterate over all listing previews from all pages without building a list"""
+        for page in self.pages:
+            if page.listing_previews:
+                yield from page.listing_previews.listings
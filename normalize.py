@@ -1,20 +1,42 @@
 from typing import List, Dict, Optional
 from pathlib import Path
+import argparse
+import asyncio
 import json
+from collections import OrderedDict
 from datetime import datetime
 from dotenv import load_dotenv
 import os
-from database import MongoManager
+from database import BulkWriter, MongoManager, close_clients
+from pymongo import UpdateOne
 from pydantic import BaseModel, Field
-from models import Gun
 from bson import ObjectId
-from openai import OpenAI
+from openai import AsyncOpenAI
+import openai
+import httpx
+from aiolimiter import AsyncLimiter
+import xxhash
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
 
 # Configuration
 NORMALIZE_ALL = False  # Set to True to normalize all listings
-BATCH_SIZE = 20  # Process listings in batches (OpenAI allows up to 20 messages per request)
+BATCH_SIZE = 20  # Process listings in batches
+CONCURRENCY = 20  # Maximum number of concurrent OpenAI requests
+REQUESTS_PER_MINUTE = 500  # Stay under the OpenRouter/OpenAI rate limit tier
+RESPONSE_CACHE_SIZE = 10000  # Model responses kept in memory for reposted listings
+
+# Only the fields create_listing_messages reads are fetched from MongoDB
+LISTING_PROJECTION = {"_id": 1, "title": 1, "description": 1, "guns": 1}
 MODEL = "openai/gpt-4o-mini"  # Model to use for normalization
 
+# Batch API configuration (--batch). OpenRouter has no Batch API, so this
+# mode talks to OpenAI directly.
+BATCH_MODEL = "gpt-4o-mini"  # OpenAI model name for batch requests
+BATCH_INPUT_FILE = Path("/tmp/gun_batch.jsonl")  # Request file uploaded to OpenAI
+BATCH_STATE_FILE = Path("batch_state.json")  # Checkpoint of the submitted batches
+BATCH_MAX_REQUESTS = 50000  # OpenAI's limit on requests in one batch input file
+BATCH_POLL_SECONDS = 60  # How often to check on a submitted batch
+
 class GunNormalization(BaseModel):
     """Normalized gun information extracted from listing"""
     manufacturer: str = Field(description="Standardized manufacturer name")
@@ -25,51 +47,117 @@ class GunNormalization(BaseModel):
     confidence: float = Field(description="Confidence score of the extraction (0-1)")
     original_text: str = Field(description="Original listing text that was analyzed")
 
+def create_http_client() -> httpx.AsyncClient:
+    """Create a keep-alive HTTP/2 client shared by all requests of a run"""
+    return httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=64, max_connections=128),
+        timeout=60
+    )
+
 def setup_openai():
     """Configure OpenAI client to use OpenRouter"""
-    return OpenAI(
+    return AsyncOpenAI(
         api_key=os.getenv("OPENROUTER_KEY"),
         base_url="https://openrouter.ai/api/v1",
+        http_client=create_http_client(),
+        max_retries=0,  # Retries are handled by create_completion
         default_headers={
             "HTTP-Referer": "https://github.com/zudsniper/gunscraper",
             "X-Title": "gunscraper"
         }
     )
 
+# Shared across batches so the rate limit holds for the whole run
+rate_limiter = AsyncLimiter(REQUESTS_PER_MINUTE, 60)
+
+def setup_openai_batch():
+    """Configure OpenAI client for the Batch API"""
+    return AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=create_http_client())
+
 def get_query(normalize_all: bool = False) -> Dict:
     """Get the appropriate MongoDB query based on normalization mode"""
     if normalize_all:
         return {}
     else:
-        return {
-            "$or": [
-                {"guns": []},  # Empty guns array
-                {"guns": None},  # No guns field
-                {"guns": {"$exists": False}},  # Missing guns field
-                {"guns": {"$size": 0}},  # Empty array
-                {"normalized_at": {"$exists": False}}  # Never normalized
-            ]
-        }
+        # Listings only get normalized_at once they have normalized guns
+        return {"normalized_at": {"$exists": False}}
+
+# Everything that is the same for every listing lives in the system prompt
+# so it forms a stable prefix that providers can cache across requests
+SYSTEM_PROMPT = """You are a firearms expert who normalizes gun listing data.
+
+Analyze each gun listing you are given and extract standardized information.
+Focus on identifying the manufacturer, model, and caliber with proper capitalization.
+Common manufacturer examples: Smith & Wesson, Sig Sauer, Glock, Ruger, etc.
+
+Rules:
+1. Manufacturer names should be properly capitalized (e.g., "Smith & Wesson" not "smith and wesson")
+2. Model names should follow manufacturer conventions (e.g., "M&P Shield" not "shield")
+3. Calibers should be standardized (e.g., ".45 ACP" not "45acp")
+4. If unsure about any field, use null
+5. Set is_gun_listing=true only if the listing is definitely for a firearm
+6. Provide a confidence score (0-1) for the extraction"""
+
+# Request parts that never change are built once and shared by every request
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+# Anthropic only caches explicitly marked prefixes, OpenAI models cache long
+# enough prefixes automatically
+CACHED_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": [{"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}]
+}
+
+RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "schema": {
+        "type": "object",
+        "properties": {
+            "manufacturer": {
+                "type": "string",
+                "description": "Standardized manufacturer name (e.g., 'Smith & Wesson', 'Sig Sauer')"
+            },
+            "model": {
+                "type": "string",
+                "description": "Standardized model name following manufacturer conventions"
+            },
+            "caliber": {
+                "type": ["string", "null"],
+                "description": "Standardized caliber (e.g., '.45 ACP', '9mm') or null if unknown"
+            },
+            "condition": {
+                "type": ["string", "null"],
+                "description": "Standardized condition (e.g., 'New', 'Used') or null if unknown"
+            },
+            "is_gun_listing": {
+                "type": "boolean",
+                "description": "True if the listing is definitely for a firearm"
+            },
+            "confidence": {
+                "type": "number",
+                "minimum": 0,
+                "maximum": 1,
+                "description": "Confidence score of the extraction"
+            }
+        },
+        "required": [
+            "manufacturer",
+            "model",
+            "caliber",
+            "condition",
+            "is_gun_listing",
+            "confidence"
+        ]
+    }
+}
 
 def create_listing_messages(listings: List[Dict]) -> List[Dict]:
-    """Create messages for batch processing"""
+    """Create one user message per listing"""
     messages = []
     for listing in listings:
-        prompt = f"""Analyze this gun listing and extract standardized information.
-        Focus on identifying the manufacturer, model, and caliber with proper capitalization.
-        Common manufacturer examples: Smith & Wesson, Sig Sauer, Glock, Ruger, etc.
-        
-        Listing Title: {listing.get('title', '')}
-        Description: {listing.get('description', '')}
-        Current Gun Data: {json.dumps(listing.get('guns', []))}
-        
-        Rules:
-        1. Manufacturer names should be properly capitalized (e.g., "Smith & Wesson" not "smith and wesson")
-        2. Model names should follow manufacturer conventions (e.g., "M&P Shield" not "shield")
-        3. Calibers should be standardized (e.g., ".45 ACP" not "45acp")
-        4. If unsure about any field, use null
-        5. Set is_gun_listing=true only if the listing is definitely for a firearm
-        6. Provide a confidence score (0-1) for the extraction"""
+        prompt = f"""Listing Title: {listing.get('title', '')}
+Description: {listing.get('description', '')}
+Current Gun Data: {json.dumps(listing.get('guns', []))}"""
 
         messages.append({
             "role": "user",
@@ -77,106 +165,159 @@ def create_listing_messages(listings: List[Dict]) -> List[Dict]:
         })
     return messages
 
-def normalize_listings_batch(client: OpenAI, listings: List[Dict]) -> List[Optional[GunNormalization]]:
-    """Normalize a batch of listings using OpenAI"""
-    try:
-        messages = create_listing_messages(listings)
-        responses = []
-
-        # Create batch request
-        response = client.chat.completions.create(
-            model=MODEL,
-            messages=[
-                {"role": "system", "content": "You are a firearms expert who normalizes gun listing data."}
-            ] + messages,
-            response_format={
-                "type": "json_schema",
-                "schema": {
-                    "type": "object",
-                    "properties": {
-                        "manufacturer": {
-                            "type": "string",
-                            "description": "Standardized manufacturer name (e.g., 'Smith & Wesson', 'Sig Sauer')"
-                        },
-                        "model": {
-                            "type": "string",
-                            "description": "Standardized model name following manufacturer conventions"
-                        },
-                        "caliber": {
-                            "type": ["string", "null"],
-                            "description": "Standardized caliber (e.g., '.45 ACP', '9mm') or null if unknown"
-                        },
-                        "condition": {
-                            "type": ["string", "null"],
-                            "description": "Standardized condition (e.g., 'New', 'Used') or null if unknown"
-                        },
-                        "is_gun_listing": {
-                            "type": "boolean",
-                            "description": "True if the listing is definitely for a firearm"
-                        },
-                        "confidence": {
-                            "type": "number",
-                            "minimum": 0,
-                            "maximum": 1,
-                            "description": "Confidence score of the extraction"
-                        }
-                    },
-                    "required": [
-                        "manufacturer",
-                        "model",
-                        "caliber",
-                        "condition",
-                        "is_gun_listing",
-                        "confidence"
-                    ]
-                }
-            }
-        )
-
-        # Process responses
-        for i, choice in enumerate(response.choices):
-            if choice.message and choice.message.content:
-                result = json.loads(choice.message.content)
-                result["original_text"] = f"{listings[i].get('title', '')} {listings[i].get('description', '')}"
-                responses.append(GunNormalization(**result))
-            else:
-                responses.append(None)
+def system_message(model: str) -> Dict:
+    """Pick the system message, marking it cacheable for Anthropic models"""
+    return CACHED_SYSTEM_MESSAGE if model.startswith("anthropic/") else SYSTEM_MESSAGE
 
-        return responses
+# OpenAI's Chat Completions API wants the schema wrapped in a named json_schema
+BATCH_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "gun_normalization",
+        "schema": RESPONSE_FORMAT["schema"]
+    }
+}
 
-    except Exception as e:
-        print(f"Error processing batch: {str(e)}")
-        return [None] * len(listings)
+def build_request_body(message: Dict, model: str = MODEL, response_format: Dict = RESPONSE_FORMAT) -> Dict:
+    """Build the chat completion request for a single listing message"""
+    return {
+        "model": model,
+        "messages": [system_message(model), message],
+        "response_format": response_format
+    }
+
+def parse_normalization(content: str, listing: Dict) -> GunNormalization:
+    """Parse a model response for a listing into a GunNormalization"""
+    result = json.loads(content)
+    result["original_text"] = f"{listing.get('title', '')} {listing.get('description', '')}"
+    return GunNormalization(**result)
+
+@retry(
+    wait=wait_exponential_jitter(1, 30),
+    stop=stop_after_attempt(6),
+    retry=retry_if_exception_type((
+        openai.RateLimitError,
+        openai.APIConnectionError,
+        openai.APITimeoutError,
+        openai.InternalServerError
+    )),
+    reraise=True
+)
+async def create_completion(client: AsyncOpenAI, body: Dict):
+    """Send a chat completion, rate limited and retried on transient errors"""
+    async with rate_limiter:
+        return await client.chat.completions.create(**body)
+
+# Model responses keyed by response_cache_key, least recently used first
+response_cache: "OrderedDict[str, str]" = OrderedDict()
+
+def response_cache_key(message: Dict, model: str = MODEL) -> str:
+    """Key a listing message by the model and the listing text it sends"""
+    return xxhash.xxh3_128_hexdigest(f"{model}|{message['content']}".encode())
+
+def get_cached_response(key: str) -> Optional[str]:
+    """Look up a cached model response, marking it recently used"""
+    content = response_cache.get(key)
+    if content is not None:
+        response_cache.move_to_end(key)
+    return content
+
+def cache_response(key: str, content: str):
+    """Cache a model response, evicting the least recently used past RESPONSE_CACHE_SIZE"""
+    response_cache[key] = content
+    response_cache.move_to_end(key)
+    if len(response_cache) > RESPONSE_CACHE_SIZE:
+        response_cache.popitem(last=False)
+
+async def fetch_normalization(
+    client: AsyncOpenAI,
+    semaphore: asyncio.Semaphore,
+    message: Dict
+) -> Optional[str]:
+    """Request the normalization of a single listing message using OpenAI"""
+    async with semaphore:
+        response = await create_completion(client, build_request_body(message))
+
+    choice = response.choices[0] if response.choices else None
+    if not (choice and choice.message and choice.message.content):
+        return None
+    
+    return choice.message.content
+
+async def normalize_listings_batch(client: AsyncOpenAI, listings: List[Dict]) -> List[Optional[GunNormalization]]:
+    """Normalize a batch of listings, sending one concurrent request per distinct uncached listing"""
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    messages = create_listing_messages(listings)
+    keys = [response_cache_key(message) for message in messages]
+    
+    # Reposted listings share a key, so each distinct listing text is sent once
+    contents = {}
+    pending = {}
+    for key, message in zip(keys, messages):
+        cached = get_cached_response(key)
+        if cached is not None:
+            contents[key] = cached
+        else:
+            pending.setdefault(key, message)
+    if contents:
+        print(f"Reusing {len(contents)} cached response(s)")
+    
+    results = await asyncio.gather(
+        *(fetch_normalization(client, semaphore, message) for message in pending.values()),
+        return_exceptions=True
+    )
+    contents.update(zip(pending, results))
+    
+    # A failed request only loses its own listing
+    responses = []
+    for listing, key in zip(listings, keys):
+        content = contents[key]
+        try:
+            if isinstance(content, Exception):
+                raise content
+            normalized = parse_normalization(content, listing) if content else None
+        except Exception as e:
+            print(f"Error processing listing {listing.get('title', 'No Title')}: {str(e)}")
+            responses.append(None)
+            continue
+        
+        if normalized:
+            cache_response(key, content)
+        responses.append(normalized)
+    
+    return responses
 
-def update_listing_guns(db: MongoManager, listing_id: ObjectId, normalized: GunNormalization):
-    """Update a listing with normalized gun data"""
+def update_listing_guns(writer: BulkWriter, listing_id: ObjectId, normalized: GunNormalization):
+    """Queue an update of a listing with normalized gun data"""
     if not normalized.is_gun_listing:
         return
     
-    gun = Gun(
-        manufacturer=normalized.manufacturer,
-        model=normalized.model,
-        caliber=normalized.caliber if normalized.caliber else "NA",
-        condition=normalized.condition if normalized.condition else "NA"
-    )
+    # The values were already validated by GunNormalization, so build the
+    # gun document directly instead of going through the Gun model
+    gun_doc = {
+        "manufacturer": normalized.manufacturer,
+        "model": normalized.model,
+        "caliber": normalized.caliber or "NA",
+        "condition": normalized.condition or "NA"
+    }
     
-    db.listings.update_one(
+    writer.add(UpdateOne(
         {"_id": listing_id},
         {
             "$set": {
-                "guns": [gun.dict()],
-                "normalized_at": datetime.now().isoformat(),
+                "guns": [gun_doc],
+                "normalized_at": datetime.utcnow(),
                 "normalization_confidence": normalized.confidence
             }
         }
-    )
+    ))
 
-def process_batch(client: OpenAI, db: MongoManager, listings: List[Dict]):
-    """Process a batch of listings"""
+async def process_batch(client: AsyncOpenAI, writer: BulkWriter, listings: List[Dict]):
+    """Process a batch of listings, queueing their updates on writer"""
     print(f"\nProcessing batch of {len(listings)} listings")
     
     try:
-        normalizations = normalize_listings_batch(client, listings)
+        normalizations = await normalize_listings_batch(client, listings)
         
         for listing, normalized in zip(listings, normalizations):
             if normalized:
@@ -188,8 +329,7 @@ def process_batch(client: OpenAI, db: MongoManager, listings: List[Dict]):
                     print(f"Model: {normalized.model}")
                     print(f"Caliber: {normalized.caliber}")
                     
-                    update_listing_guns(db, listing["_id"], normalized)
-                    print("Updated listing in database")
+                    update_listing_guns(writer, listing["_id"], normalized)
             
     except KeyboardInterrupt:
         print("\nProcess interrupted by user. Saving progress...")
@@ -199,8 +339,145 @@ def process_batch(client: OpenAI, db: MongoManager, listings: List[Dict]):
     
     return True
 
-def main():
+async def flush_updates(writer: BulkWriter):
+    """Write queued listing updates from a worker thread so the event loop keeps running"""
+    await asyncio.to_thread(writer.flush)
+    print("Updated listings in database")
+
+def fetch_listings_page(db: MongoManager, query: Dict, last_id: Optional[ObjectId]) -> List[Dict]:
+    """Fetch the next page of listings after last_id"""
+    # Paging on _id rather than skip() makes each page an index seek and
+    # keeps processed listings from shifting pages
+    page_query = {**query, "_id": {"$gt": last_id}} if last_id else query
+    return list(db.listings.find(page_query, LISTING_PROJECTION).sort("_id", 1).limit(BATCH_SIZE))
+
+async def submit_batch(client: AsyncOpenAI, listings: List[Dict]) -> str:
+    """Upload listing requests as a batch job and return its ID"""
+    with open(BATCH_INPUT_FILE, 'w') as f:
+        for listing, message in zip(listings, create_listing_messages(listings)):
+            f.write(json.dumps({
+                "custom_id": str(listing["_id"]),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": build_request_body(message, model=BATCH_MODEL, response_format=BATCH_RESPONSE_FORMAT)
+            }) + "\n")
+    
+    with open(BATCH_INPUT_FILE, 'rb') as f:
+        batch_file = await client.files.create(file=f, purpose="batch")
+    batch = await client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+    
+    print(f"Submitted batch {batch.id} with {len(listings)} listings")
+    return batch.id
+
+async def submit_batches(client: AsyncOpenAI, listings: List[Dict]) -> List[str]:
+    """Split listings into batch jobs of at most BATCH_MAX_REQUESTS and checkpoint their IDs"""
+    batch_ids = []
+    for start in range(0, len(listings), BATCH_MAX_REQUESTS):
+        batch_ids.append(await submit_batch(client, listings[start:start + BATCH_MAX_REQUESTS]))
+        
+        # Checkpoint after every submission so a restart resumes these batches
+        # instead of resubmitting; listings not yet submitted stay unnormalized
+        # and get picked up by the next run
+        with open(BATCH_STATE_FILE, 'w') as f:
+            json.dump({
+                "batch_ids": batch_ids,
+                "num_listings": len(listings),
+                "submitted_at": datetime.now().isoformat()
+            }, f, indent=4)
+    return batch_ids
+
+async def wait_for_batch(client: AsyncOpenAI, batch_id: str):
+    """Poll a batch job until it reaches a terminal status"""
+    while True:
+        batch = await client.batches.retrieve(batch_id)
+        if batch.status in ("completed", "failed", "expired", "cancelled"):
+            return batch
+        
+        counts = batch.request_counts
+        print(f"Batch {batch_id} is {batch.status} ({counts.completed}/{counts.total} done)")
+        await asyncio.sleep(BATCH_POLL_SECONDS)
+
+async def ingest_batch_results(client: AsyncOpenAI, db: MongoManager, batch) -> int:
+    """Apply the results of a finished batch job to the listings"""
+    if not batch.output_file_id:
+        return 0
+    output = await client.files.content(batch.output_file_id)
+    records = [json.loads(line) for line in output.text.splitlines() if line.strip()]
+    
+    # Fetch the listing text needed for original_text in one query
+    listing_ids = [ObjectId(record["custom_id"]) for record in records]
+    listings = {
+        str(listing["_id"]): listing
+        for listing in db.listings.find({"_id": {"$in": listing_ids}}, {"title": 1, "description": 1})
+    }
+    
+    writer = BulkWriter(db.listings)
+    updated = 0
+    for record in records:
+        listing = listings.get(record["custom_id"])
+        response = record.get("response") or {}
+        if not listing or response.get("status_code") != 200:
+            print(f"No result for listing {record['custom_id']}: {record.get('error')}")
+            continue
+        
+        try:
+            content = response["body"]["choices"][0]["message"]["content"]
+            normalized = parse_normalization(content, listing)
+        except Exception as e:
+            print(f"Error parsing result for listing {record['custom_id']}: {str(e)}")
+            continue
+        
+        if normalized.is_gun_listing:
+            update_listing_guns(writer, listing["_id"], normalized)
+            updated += 1
+    
+    writer.flush()
+    return updated
+
+async def run_batch(db: MongoManager, query: Dict):
+    """Normalize listings through the OpenAI Batch API, resuming a checkpointed batch if present"""
+    client = setup_openai_batch()
+    
+    try:
+        if BATCH_STATE_FILE.exists():
+            with open(BATCH_STATE_FILE, 'r') as f:
+                batch_ids = json.load(f)["batch_ids"]
+            print(f"Resuming batches {', '.join(batch_ids)}")
+        else:
+            listings = list(db.listings.find(query, LISTING_PROJECTION))
+            print(f"Found {len(listings)} listings to normalize")
+            if not listings:
+                return
+            batch_ids = await submit_batches(client, listings)
+        
+        for batch_id in batch_ids:
+            batch = await wait_for_batch(client, batch_id)
+            if batch.status == "completed":
+                updated = await ingest_batch_results(client, db, batch)
+                print(f"Updated {updated} listings from batch {batch_id}")
+            else:
+                print(f"Batch {batch_id} finished with status {batch.status}")
+        
+        BATCH_STATE_FILE.unlink()
+    finally:
+        await client.close()
+
+async def main(use_batch_api: bool = False):
     load_dotenv()
+    
+    if use_batch_api:
+        db = MongoManager()
+        try:
+            await run_batch(db, get_query(NORMALIZE_ALL))
+            print("\nNormalization complete!")
+        finally:
+            close_clients()
+        return
+    
     client = setup_openai()
     
     # Initialize MongoDB connection
@@ -213,13 +490,33 @@ def main():
         total_listings = db.listings.count_documents(query)
         print(f"Found {total_listings} listings to normalize")
         
-        # Process listings in batches
-        for skip in range(0, total_listings, BATCH_SIZE):
-            print(f"\nProcessing batch {skip//BATCH_SIZE + 1}/{(total_listings + BATCH_SIZE - 1)//BATCH_SIZE}")
-            
-            batch = list(db.listings.find(query).skip(skip).limit(BATCH_SIZE))
-            if not process_batch(client, db, batch):
-                break
+        # Process listings in batches. Each batch's database writes run in the
+        # background while the next batch's requests are in flight
+        total_batches = (total_listings + BATCH_SIZE - 1) // BATCH_SIZE
+        last_id = None
+        batch_num = 0
+        pending_write = None
+        try:
+            while True:
+                batch = await asyncio.to_thread(fetch_listings_page, db, query, last_id)
+                if not batch:
+                    break
+                last_id = batch[-1]["_id"]
+                batch_num += 1
+                print(f"\nProcessing batch {batch_num}/{total_batches}")
+                
+                writer = BulkWriter(db.listings)
+                keep_going = await process_batch(client, writer, batch)
+                
+                # Keep at most one write in flight
+                if pending_write:
+                    await pending_write
+                pending_write = asyncio.create_task(flush_updates(writer))
+                if not keep_going:
+                    break
+        finally:
+            if pending_write:
+                await pending_write
         
         print("\nNormalization complete!")
         
@@ -227,7 +524,15 @@ def main():
         print(f"Error during normalization: {str(e)}")
         raise
     finally:
-        db.close()
+        await client.close()
+        close_clients()
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Normalize gun data on scraped listings")
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Submit all pending listings through the OpenAI Batch API (cheaper, not realtime)"
+    )
+    args = parser.parse_args()
+    asyncio.run(main(use_batch_api=args.batch)) 
\ No newline at end of file
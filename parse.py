@@ -1,82 +1,220 @@
 from pathlib import Path
+import argparse
+import ijson
 import json
-from collections import Counter, defaultdict
-from statistics import mean, median, stdev
-from typing import List, Dict
-from models import ListingsPages, ListingPreview
+import msgspec
+from collections import defaultdict
+import numpy as np
+import polars as pl
+from typing import Iterator, List, Dict, Optional
+from models import ListingPreview
 from pprint import pprint
 from datetime import datetime
 from dotenv import load_dotenv
 import os
-from database import MongoManager
+from database import MongoManager, close_clients
 
-def load_scraped_data(file_path: Path = Path("scraping_results.json")) -> tuple[ListingsPages, dict]:
-    """Load the scraped data from JSON file"""
-    with open(file_path, 'r') as f:
-        data = json.load(f)
-        return ListingsPages(**data["data"]), data
+# Top-level result fields needed to record a scraping session
+SESSION_FIELDS = ("url", "start_time", "end_time", "status")
 
-def calculate_price_stats(listings: List[ListingPreview]) -> Dict:
+def load_session_metadata(
+    file_path: Path = Path("scraping_results.json"),
+    execution_info_path: Path = Path("execution_info.jsonl")
+) -> dict:
+    """Stream the session fields out of the scraped JSON file without loading the pages"""
+    metadata = {"data": {"num_pages": None}, "execution_info": []}
+    with open(file_path, 'rb') as f:
+        for prefix, event, value in ijson.parse(f, use_float=True):
+            if prefix in SESSION_FIELDS and event not in ("start_map", "start_array"):
+                metadata[prefix] = value
+            elif prefix == "data.num_pages":
+                metadata["data"]["num_pages"] = value
+    
+    # The scraper logs execution info to its own file; older results embed it
+    if execution_info_path.exists():
+        with open(execution_info_path, 'r') as f:
+            metadata["execution_info"] = [json.loads(line) for line in f if line.strip()]
+    else:
+        with open(file_path, 'rb') as f:
+            for execution_info in ijson.items(f, "execution_info", use_float=True):
+                metadata["execution_info"] = execution_info
+    return metadata
+
+def iter_scraped_listings(file_path: Path = Path("scraping_results.json")) -> Iterator[ListingPreview]:
+    """Stream listing previews from the scraped JSON file one at a time"""
+    with open(file_path, 'rb') as f:
+        for listing in ijson.items(f, "data.pages.item.listing_previews.listings.item", use_float=True):
+            yield ListingPreview.model_validate(listing)
+
+class GunSummary(msgspec.Struct, frozen=True):
+    """Gun fields read by the analytics"""
+    manufacturer: Optional[str] = None
+    model: Optional[str] = None
+    caliber: Optional[str] = None
+    condition: Optional[str] = None
+
+class ListingSummary(msgspec.Struct, frozen=True):
+    """Listing fields read by the analytics"""
+    price: float = 0.0
+    image_urls: List[str] = []
+    guns: Optional[List[GunSummary]] = None
+
+class _ListingSummaries(msgspec.Struct, frozen=True):
+    listings: List[ListingSummary] = []
+
+class _PageSummary(msgspec.Struct, frozen=True):
+    listing_previews: Optional[_ListingSummaries] = None
+
+class _PagesSummary(msgspec.Struct, frozen=True):
+    pages: List[_PageSummary] = []
+
+class _ScrapingResultSummary(msgspec.Struct, frozen=True):
+    data: Optional[_PagesSummary] = None
+
+def load_listing_summaries(file_path: Path = Path("scraping_results.json")) -> List[ListingSummary]:
+    """Decode only the fields the analytics use straight from the scraped JSON bytes"""
+    with open(file_path, 'rb') as f:
+        result = msgspec.json.decode(f.read(), type=_ScrapingResultSummary)
+    if not result.data:
+        return []
+    return [
+        listing
+        for page in result.data.pages
+        if page.listing_previews
+        for listing in page.listing_previews.listings
+    ]
+
+# Upper bounds (inclusive) of the price buckets below the open-ended "2001+" bucket
+PRICE_BUCKET_EDGES = np.array([500, 1000, 2000], dtype=np.float64)
+
+def calculate_price_stats(listings: List[ListingSummary]) -> Dict:
     """Calculate price statistics"""
+    prices = np.fromiter((l.price for l in listings), dtype=np.float64, count=len(listings))
     # Filter out $0 prices which are likely "make offer"
-    prices = [l.price for l in listings if l.price > 0]
+    prices = prices[prices > 0]
+    count = len(prices)
+    
+    # side="left" keeps the bucket upper bounds inclusive
+    buckets = np.bincount(np.searchsorted(PRICE_BUCKET_EDGES, prices, side="left"), minlength=4)
     
     return {
         "type": "price_stats",
-        "count": len(prices),
-        "mean": round(mean(prices), 2),
-        "median": round(median(prices), 2),
-        "std_dev": round(stdev(prices), 2) if len(prices) > 1 else 0,
-        "min": min(prices) if prices else 0,
-        "max": max(prices) if prices else 0,
+        "count": count,
+        "mean": round(float(prices.mean()), 2) if count else 0,
+        "median": round(float(np.median(prices)), 2) if count else 0,
+        "std_dev": round(float(prices.std(ddof=1)), 2) if count > 1 else 0,
+        "min": float(prices.min()) if count else 0,
+        "max": float(prices.max()) if count else 0,
         "price_ranges": {
-            "0-500": len([p for p in prices if p <= 500]),
-            "501-1000": len([p for p in prices if 500 < p <= 1000]),
-            "1001-2000": len([p for p in prices if 1000 < p <= 2000]),
-            "2001+": len([p for p in prices if p > 2000])
+            "0-500": int(buckets[0]),
+            "501-1000": int(buckets[1]),
+            "1001-2000": int(buckets[2]),
+            "2001+": int(buckets[3])
         }
     }
 
-def analyze_guns(listings: List[ListingPreview]) -> Dict:
+# Gun fields counted by analyze_guns
+GUN_FIELDS = ("manufacturer", "model", "caliber", "condition")
+
+def _top_values(guns: pl.LazyFrame, field: str, limit: Optional[int] = None) -> pl.LazyFrame:
+    """Count a gun field's known values, most common first"""
+    counts = (
+        guns
+        .filter(pl.col(field).is_not_null() & (pl.col(field) != "") & (pl.col(field) != "NA"))
+        .group_by(field)
+        .agg(pl.len().alias("count"))
+        .sort(["count", field], descending=[True, False])
+    )
+    return counts.head(limit) if limit else counts
+
+def analyze_guns(listings: List[ListingSummary]) -> Dict:
     """Analyze gun-related statistics"""
-    manufacturers = Counter()
-    models = Counter()
-    calibers = Counter()
-    conditions = Counter()
+    # Flatten all guns once into columns, then run every count in one Polars plan
+    guns = [gun for listing in listings if listing.guns for gun in listing.guns]
+    frame = pl.LazyFrame(
+        {field: [getattr(gun, field) for gun in guns] for field in GUN_FIELDS},
+        schema={field: pl.Utf8 for field in GUN_FIELDS}
+    )
+    manufacturers, models, calibers, conditions = pl.collect_all([
+        _top_values(frame, "manufacturer", 10),
+        _top_values(frame, "model", 10),
+        _top_values(frame, "caliber", 10),
+        _top_values(frame, "condition")
+    ])
     
-    for listing in listings:
-        if listing.guns:
-            for gun in listing.guns:
-                if gun.manufacturer != "NA":
-                    manufacturers[gun.manufacturer] += 1
-                if gun.model != "NA":
-                    models[gun.model] += 1
-                if gun.caliber != "NA":
-                    calibers[gun.caliber] += 1
-                if gun.condition and gun.condition != "NA":
-                    conditions[gun.condition] += 1
+    def as_dict(counts: pl.DataFrame) -> Dict[str, int]:
+        return dict(zip(counts[counts.columns[0]].to_list(), counts["count"].to_list()))
     
     return {
         "type": "gun_stats",
-        "top_manufacturers": dict(manufacturers.most_common(10)),
-        "top_models": dict(models.most_common(10)),
-        "top_calibers": dict(calibers.most_common(10)),
-        "conditions": dict(conditions.most_common())
+        "top_manufacturers": as_dict(manufacturers),
+        "top_models": as_dict(models),
+        "top_calibers": as_dict(calibers),
+        "conditions": as_dict(conditions)
     }
 
-def analyze_listings(listings: List[ListingPreview]) -> Dict:
+def _count_distribution(values: np.ndarray) -> Dict[str, int]:
+    """Count occurrences of each non-negative integer value, most common first"""
+    counts = np.bincount(values)
+    order = np.argsort(-counts, kind="stable")
+    return {str(int(k)): int(counts[k]) for k in order if counts[k]}
+
+def analyze_listings(listings: List[ListingSummary]) -> Dict:
     """Analyze listing patterns"""
-    guns_per_listing = Counter(len(listing.guns) if listing.guns else 0 for listing in listings)
-    images_per_listing = Counter(len(listing.image_urls) for listing in listings)
+    # Fill both per-listing counts in a single pass over the listings
+    guns_per_listing = np.zeros(len(listings), dtype=np.int32)
+    images_per_listing = np.zeros(len(listings), dtype=np.int32)
+    for i, listing in enumerate(listings):
+        if listing.guns:
+            guns_per_listing[i] = len(listing.guns)
+        images_per_listing[i] = len(listing.image_urls)
     
     return {
         "type": "listing_stats",
         "total_listings": len(listings),
-        "listings_with_guns": len([l for l in listings if l.guns]),
-        "guns_per_listing": {str(k): v for k, v in guns_per_listing.most_common()},
-        "images_per_listing": {str(k): v for k, v in images_per_listing.most_common()}
+        "listings_with_guns": int(np.count_nonzero(guns_per_listing)),
+        "guns_per_listing": _count_distribution(guns_per_listing),
+        "images_per_listing": _count_distribution(images_per_listing)
     }
 
+def stats_from_facets(facets: Dict) -> tuple[Dict, Dict, Dict]:
+    """Shape MongoManager.aggregate_session_stats output like the in-memory statistics"""
+    price = facets["price"][0] if facets["price"] else {}
+    price_ranges = {bucket["_id"]: bucket["count"] for bucket in facets["price_ranges"]}
+    totals = facets["totals"][0] if facets["totals"] else {}
+    
+    def counts(name: str) -> Dict:
+        return {str(group["_id"]): group["count"] for group in facets[name]}
+    
+    price_stats = {
+        "type": "price_stats",
+        "count": price.get("count", 0),
+        "mean": round(price["mean"], 2) if price else 0,
+        "median": round(price["median"], 2) if price else 0,
+        "std_dev": round(price["std_dev"], 2) if price.get("std_dev") else 0,
+        "min": price.get("min", 0),
+        "max": price.get("max", 0),
+        "price_ranges": {
+            name: price_ranges.get(name, 0)
+            for name in ("0-500", "501-1000", "1001-2000", "2001+")
+        }
+    }
+    gun_stats = {
+        "type": "gun_stats",
+        "top_manufacturers": counts("manufacturers"),
+        "top_models": counts("models"),
+        "top_calibers": counts("calibers"),
+        "conditions": counts("conditions")
+    }
+    listing_stats = {
+        "type": "listing_stats",
+        "total_listings": totals.get("total_listings", 0),
+        "listings_with_guns": totals.get("listings_with_guns", 0),
+        "guns_per_listing": counts("guns_per_listing"),
+        "images_per_listing": counts("images_per_listing")
+    }
+    return price_stats, gun_stats, listing_stats
+
 def print_analysis_results(price_stats: Dict, gun_stats: Dict, listing_stats: Dict):
     """Print analysis results in a readable format"""
     print("\n=== Price Statistics ===")
@@ -111,7 +249,7 @@ def print_analysis_results(price_stats: Dict, gun_stats: Dict, listing_stats: Di
                                     key=lambda x: int(x[0])):
         print(f"{num_guns_str} gun(s): {count} listings")
 
-def main():
+def main(session_id: Optional[str] = None):
     # Load environment variables
     load_dotenv()
     
@@ -119,22 +257,28 @@ def main():
         # Initialize MongoDB connection
         db = MongoManager()
         
-        # Load and process data
-        listings_pages, raw_data = load_scraped_data()
-        listings = listings_pages.all_listings
-        
-        # Save scraping session and get session ID
-        session_id = db.save_scraping_session(raw_data)
-        print(f"\nCreated new scraping session: {session_id}")
-        
-        # Save listings
-        db.save_listings(session_id, listings)
-        print(f"Saved {len(listings)} listings to database")
-        
-        # Calculate statistics
-        price_stats = calculate_price_stats(listings)
-        gun_stats = analyze_guns(listings)
-        listing_stats = analyze_listings(listings)
+        if session_id:
+            # Recompute statistics for a stored session inside MongoDB
+            price_stats, gun_stats, listing_stats = stats_from_facets(
+                db.aggregate_session_stats(session_id)
+            )
+        else:
+            # Decode the lightweight analytics view of the listings with msgspec
+            listings = load_listing_summaries()
+            
+            # Save scraping session and get session ID
+            session_id = db.save_scraping_session(load_session_metadata())
+            print(f"\nCreated new scraping session: {session_id}")
+            
+            # Save listings, streaming the full models from the file so they
+            # are never all held in memory at once
+            db.save_listings(session_id, iter_scraped_listings(), new_session=True)
+            print(f"Saved {len(listings)} listings to database")
+            
+            # Calculate statistics
+            price_stats = calculate_price_stats(listings)
+            gun_stats = analyze_guns(listings)
+            listing_stats = analyze_listings(listings)
         
         # Save statistics
         for stats in [price_stats, gun_stats, listing_stats]:
@@ -148,9 +292,13 @@ def main():
         raise
     finally:
         # Ensure database connection is closed
-        if 'db' in locals():
-            db.close()
+        close_clients()
 
 if __name__ == "__main__":
-    main()
-  
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Analyze scraped listings")
+    parser.add_argument(
+        "--session",
+        help="Recompute statistics for an already stored session in MongoDB instead of loading scraping_results.json"
+    )
+    args = parser.parse_args()
+    main(session_id=args.session)
@@ -1,10 +1,14 @@
 import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-import json
+import orjson
 from dotenv import load_dotenv
 from scrapegraphai.graphs import SmartScraperGraph
 from scrapegraphai.utils import prettify_exec_info
-from models import ListingPreviews, ListingsPages, ListingsPage
+from models import ListingPreview, ListingPreviews, ListingsItems, ListingsPages, ListingsPage
+from llm_cache import DiskCache, cache_key
+from listings_parser import ListingParseError, has_listings_markup, parse_listings
 from pydantic import BaseModel, Field
 from datetime import datetime
 import traceback
@@ -13,6 +17,13 @@ from enum import Enum
 from typing import Optional, Dict, Any, Tuple
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_result
 import time
+import httpx
+
+SCRAPE_CONCURRENCY = 8  # Pages scraped at once, overridable with the SCRAPE_CONCURRENCY env var
+
+# Parsed LLM results, so reruns and retries of a page skip the LLM
+llm_cache = DiskCache()
+PAGE_COUNT_TTL = 24 * 60 * 60  # New listings add pages, so the page count is re-scraped daily
 
 listing_page_prompt = """
 Extract all listings from this page. 
@@ -33,6 +44,74 @@ For each listing, identify the type of item(s) and extract relevant information:
 - listing_url
 """
 
+listing_items_prompt = """
+Identify the items for sale in each of these listings from its title and description.
+For each listing, return:
+
+- listing_url: exactly as given
+- items: List of items in the listing, each with:
+    - item_type: gun, magazine, ammunition, optic, light, holster, body_armor, or other
+    - manufacturer
+    - model
+    - caliber (for guns, magazines, ammunition)
+    - condition (for guns)
+    - capacity (for magazines)
+    - quantity (for ammunition)
+"""
+
+# Shared by every LangChain model so all pages reuse the same kept-alive connections
+_http_client: Optional[httpx.Client] = None
+
+def get_http_client() -> httpx.Client:
+    """Get the shared HTTP/2 client for LLM requests, creating it on first use"""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.Client(
+            transport=httpx.HTTPTransport(
+                http2=True,
+                limits=httpx.Limits(max_keepalive_connections=32, max_connections=32),
+                retries=3  # Retries failed connection attempts only
+            ),
+            timeout=60
+        )
+    return _http_client
+
+# Listing pages are static HTML, so they are fetched directly instead of
+# starting a browser for each one
+PAGE_FETCH_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+                  "(KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36"
+}
+_page_client: Optional[httpx.Client] = None
+
+def get_page_client(graph_config: Dict) -> httpx.Client:
+    """Get the shared client for fetching pages, using the graph config's proxy"""
+    global _page_client
+    if _page_client is None:
+        proxy = graph_config.get("loader_kwargs", {}).get("proxy")
+        _page_client = httpx.Client(
+            transport=httpx.HTTPTransport(
+                http2=True,
+                limits=httpx.Limits(max_keepalive_connections=SCRAPE_CONCURRENCY, max_connections=32),
+                proxy=httpx.Proxy(proxy["server"], auth=(proxy["username"], proxy["password"])) if proxy else None,
+                retries=3
+            ),
+            headers=PAGE_FETCH_HEADERS,
+            follow_redirects=True,
+            timeout=30
+        )
+    return _page_client
+
+def fetch_page_html(page_url: str, graph_config: Dict) -> Optional[str]:
+    """Fetch a page's HTML directly, or None to let the graph's browser load it"""
+    try:
+        response = get_page_client(graph_config).get(page_url)
+        response.raise_for_status()
+        return response.text
+    except httpx.HTTPError as e:
+        print(f"Direct fetch of {page_url} failed, falling back to the browser: {str(e)}")
+        return None
+
 class LLMProvider(str, Enum):
     OPENROUTER = "openrouter"
     LANGCHAIN = "langchain"
@@ -99,7 +178,8 @@ def get_graph_config(
             model_instance = ChatOpenAI(
                 openai_api_key=os.getenv("OPENROUTER_KEY"),
                 openai_api_base="https://openrouter.ai/api/v1",
-                model_name=model
+                model_name=model,
+                http_client=get_http_client()
             )
         
         config["llm"] = {
@@ -115,28 +195,18 @@ def get_graph_config(
     
     return config
 
-def get_page_count(url: str, config: dict) -> tuple[int, dict]:
-    """Get total page count, either from cache or by scraping"""
-    cache_file = Path("page_count_cache.json")
-    
-    # Check cache first
-    if cache_file.exists():
-        with open(cache_file, 'r') as f:
-            cached = json.load(f)
-            print("Using cached page count")
-            return cached["page_count"], cached["execution_info"]
-    
-    # If not cached, scrape it
-    get_last_page_prompt = """
-    Find the last page number from the pagination buttons at the bottom of the page. (total_pages)
-    Return only the highest page number you find.
-    """
+def graph_model_name(config: Dict) -> str:
+    """Name of the model a graph config uses, for cache keys"""
+    llm = config.get("llm", {})
+    return llm.get("model") or getattr(llm.get("model_instance"), "model_name", "")
 
+def scrape_page_count(prompt: str, url: str, config: dict) -> tuple[int, dict]:
+    """Scrape the total page count from the pagination of the first page"""
     class PageCount(BaseModel):
         total_pages: int = Field(description="The highest page number found in the pagination")
     
     smart_scraper_graph = SmartScraperGraph(
-        prompt=get_last_page_prompt,
+        prompt=prompt,
         source=url,
         config=config,
         schema=PageCount
@@ -146,14 +216,34 @@ def get_page_count(url: str, config: dict) -> tuple[int, dict]:
     page_count = page_count_result["total_pages"]
     
     exec_info = smart_scraper_graph.get_execution_info()
+    return page_count, exec_info
+
+def get_page_count(url: str, config: dict) -> tuple[int, dict]:
+    """Get total page count, either from cache or by scraping"""
+    get_last_page_prompt = """
+    Find the last page number from the pagination buttons at the bottom of the page. (total_pages)
+    Return only the highest page number you find.
+    """
+    key = cache_key(get_last_page_prompt, url, "PageCount", graph_model_name(config))
     
-    # Cache the result
-    with open(cache_file, 'w') as f:
-        json.dump({
-            "page_count": page_count,
-            "execution_info": exec_info,
-            "cached_at": datetime.now().isoformat()
-        }, f, indent=4)
+    # Check cache first
+    cached = llm_cache.get(key)
+    if cached:
+        print("Using cached page count")
+        return cached["page_count"], cached["execution_info"]
+    
+    # Scrapers started together would all miss the cache, so only the one
+    # holding the lock scrapes and the rest pick up its result
+    with llm_cache.lock():
+        cached = llm_cache.get(key)
+        if cached:
+            print("Using cached page count")
+            return cached["page_count"], cached["execution_info"]
+        
+        page_count, exec_info = scrape_page_count(get_last_page_prompt, url, config)
+        
+        # Cache the result
+        llm_cache.set(key, {"page_count": page_count, "execution_info": exec_info}, ttl=PAGE_COUNT_TTL)
     
     return page_count, exec_info
 
@@ -165,7 +255,7 @@ def create_result_template(url: str, start_time: datetime) -> dict:
         "status": "started",
         "last_completed_page": None,
         "error": None,
-        "execution_info": [],
+        "execution_info_count": 0,  # Entries written to execution_info.jsonl
         "data": None,
         "end_time": None,
         "duration_seconds": None
@@ -175,10 +265,27 @@ def save_progress(result: dict, start_time: datetime, output_path: Path = Path("
     """Save current progress to file"""
     result["end_time"] = datetime.now().isoformat()
     result["duration_seconds"] = (datetime.now() - start_time).total_seconds()
-    with open(output_path, 'w') as f:
-        json.dump(result, f, indent=4)
+    with open(output_path, 'wb') as f:
+        data = result.get("data")
+        if isinstance(data, BaseModel):
+            # Let pydantic write the pages straight to JSON rather than
+            # dumping them to dicts first and encoding those again
+            metadata = orjson.dumps({k: v for k, v in result.items() if k != "data"}, option=orjson.OPT_INDENT_2)
+            f.write(metadata[:-2] + b',\n  "data": ')
+            f.write(data.model_dump_json().encode())
+            f.write(b"\n}")
+        else:
+            f.write(orjson.dumps(result, option=orjson.OPT_INDENT_2))
     print(f"\nProgress saved to {output_path}")
 
+def load_finished_pages(pages_path: Path = Path("scraping_pages.jsonl")) -> ListingsPages:
+    """Load the pages a run has finished so far from its JSONL file"""
+    pages = ListingsPages(pages=[])
+    if pages_path.exists():
+        with open(pages_path, 'r') as f:
+            pages.pages = [ListingsPage.model_validate_json(line) for line in f if line.strip()]
+    return pages
+
 def is_empty_listings(result: Tuple[Any, Dict]) -> bool:
     """Check if the listings result is empty or invalid"""
     listing_previews, _ = result
@@ -210,6 +317,64 @@ def is_empty_listings(result: Tuple[Any, Dict]) -> bool:
         print(f"Error checking listings: {str(e)}")
         return True
 
+class NoListingsOnPage(Exception):
+    """Neither the fetched HTML nor the browser-loaded page has listings, so an empty result is final"""
+
+# Raw HTML fetched ourselves by the first attempt at each page, so retries of
+# an empty result only rerun the LLM extraction. Pages the graph loads in its
+# browser aren't kept, since its document is already converted (e.g. to markdown)
+page_html_cache: Dict[str, str] = {}
+
+def listing_items_source(listing_previews: ListingPreviews) -> str:
+    """Text of the parsed listings the items are extracted from"""
+    return "\n\n".join(
+        f"Listing URL: {listing.listing_url}\nTitle: {listing.title}\nDescription: {listing.description}"
+        for listing in listing_previews.listings
+    )
+
+def extract_listing_items(
+    listing_previews: ListingPreviews,
+    graph_config: Dict
+) -> Tuple[Optional[ListingPreviews], Dict]:
+    """
+    Fill in the items of listings parsed from the page markup with the LLM
+    
+    Returns:
+        Tuple of (ListingPreviews with items, execution_info), with None
+        instead of the listings if the extraction failed
+    """
+    try:
+        # Only the titles and descriptions are sent, the rest is already parsed
+        smart_scraper_graph = SmartScraperGraph(
+            prompt=listing_items_prompt,
+            source=listing_items_source(listing_previews),
+            config=graph_config,
+            schema=ListingsItems,
+        )
+        listings_items = smart_scraper_graph.run()
+        exec_info = smart_scraper_graph.get_execution_info()
+        if isinstance(listings_items, BaseModel):
+            listings_items = listings_items.model_dump()
+        
+        items_by_url = {
+            listing["listing_url"]: listing.get("items") or []
+            for listing in (listings_items or {}).get("listings", [])
+        }
+        if not any(listing.listing_url in items_by_url for listing in listing_previews.listings):
+            print("No items extracted for the parsed listings")
+            return None, exec_info
+        
+        return ListingPreviews(listings=[
+            ListingPreview.model_validate({
+                **listing.model_dump(),
+                "items": items_by_url.get(listing.listing_url, [])
+            })
+            for listing in listing_previews.listings
+        ]), exec_info
+    except Exception as e:
+        print(f"Error extracting listing items: {str(e)}")
+        return None, {}
+
 @retry(
     stop=stop_after_attempt(3),
     wait=wait_exponential(multiplier=1, min=4, max=10),
@@ -222,12 +387,46 @@ def scrape_page(page_url: str, graph_config: Dict) -> Tuple[Optional[ListingPrev
     Returns:
         Tuple of (ListingPreviews, execution_info)
     """
+    key = cache_key(listing_page_prompt, page_url, "ListingPreviews", graph_model_name(graph_config))
+    cached = llm_cache.get(key)
+    if cached:
+        print(f'Using cached listings for {page_url}')
+        return ListingPreviews(**cached), {}
+    
     print(f'Attempting to scrape {page_url}')
     
+    fetched_without_markup = False
+    if page_url not in page_html_cache:
+        html = fetch_page_html(page_url, graph_config)
+        # A fetched page without listings markup is more likely a bot check
+        # than a real page, so it gets loaded in the browser instead
+        if html is not None and has_listings_markup(html):
+            page_html_cache[page_url] = html
+        elif html is not None:
+            fetched_without_markup = True
+            print(f"No listings markup in the HTML fetched for {page_url}, loading it in the browser")
+    
+    # Parsing the known markup is free and deterministic, so the LLM is only
+    # needed for the items, or for the whole page when the markup doesn't match
+    html = page_html_cache.get(page_url)
+    if html is not None:
+        try:
+            listing_previews = parse_listings(html, page_url)
+        except ListingParseError as e:
+            print(f"{str(e)}, using the LLM instead")
+        else:
+            print(f"Parsed {len(listing_previews.listings)} listings from the page markup")
+            listing_previews, exec_info = extract_listing_items(listing_previews, graph_config)
+            if listing_previews:
+                llm_cache.set(key, listing_previews.model_dump(mode="json"))
+                return listing_previews, exec_info
+            print("Scraping the whole page with the LLM instead")
+    
     try:
+        # SmartScraperGraph treats a source that isn't a URL as the page's HTML
         smart_scraper_graph = SmartScraperGraph(
             prompt=listing_page_prompt,
-            source=page_url,
+            source=page_html_cache.get(page_url, page_url),
             config=graph_config,
             schema=ListingPreviews,
         )
@@ -248,26 +447,63 @@ def scrape_page(page_url: str, graph_config: Dict) -> Tuple[Optional[ListingPrev
                 return None, exec_info
             
         if not listing_previews.listings:
+            # Past the last page, both the fetched HTML and the browser come
+            # back without listings, so retrying the LLM would be wasted
+            if fetched_without_markup:
+                raise NoListingsOnPage(page_url)
             print("Empty listings found, will retry...")
+        else:
+            llm_cache.set(key, listing_previews.model_dump(mode="json"))
             
         return listing_previews, exec_info
         
+    except NoListingsOnPage:
+        raise
     except Exception as e:
         print(f"Error during page scrape: {str(e)}")
         return None, {}
 
-def run_scraper(url: str, result: dict, start_time: datetime, graph_config: Optional[Dict] = None) -> dict:
+async def scrape_page_async(
+    page_num: int,
+    page_url: str,
+    graph_config: Dict,
+    executor: ThreadPoolExecutor
+) -> Tuple[int, Optional[ListingsPage], Dict]:
+    """Scrape a page on the executor's threads, returning its page number with the result"""
+    loop = asyncio.get_running_loop()
+    try:
+        listing_previews, exec_info = await loop.run_in_executor(executor, scrape_page, page_url, graph_config)
+    except NoListingsOnPage:
+        print(f"Page {page_num} has no listings")
+        listing_previews, exec_info = ListingPreviews(listings=[]), {}
+    except Exception as e:
+        print(f"Error scraping page {page_num}: {str(e)}")
+        print("Continuing to next page...")
+        return page_num, None, {}
+    finally:
+        # The page won't be retried again
+        page_html_cache.pop(page_url, None)
+    
+    page = ListingsPage(
+        page_url=page_url,
+        page_number=page_num,
+        listing_previews=listing_previews
+    )
+    return page_num, page, exec_info
+
+async def run_scraper(url: str, result: dict, start_time: datetime, graph_config: Optional[Dict] = None) -> dict:
     """Run scraper for a single URL"""
     output_path = Path("scraping_results.json")
+    pages_path = Path("scraping_pages.jsonl")  # Finished pages, one per line, appended as they complete
+    execution_info_path = Path("execution_info.jsonl")  # Execution info of each graph run, one per line
     start_page = 1
-    execution_info = []
     
     if output_path.exists():
-        with open(output_path, 'r') as f:
-            previous_run = json.load(f)
+        with open(output_path, 'rb') as f:
+            previous_run = orjson.loads(f.read())
             if previous_run["status"] == "failed" and previous_run["last_completed_page"]:
                 start_page = previous_run["last_completed_page"] + 1
-                execution_info = previous_run["execution_info"]
+                result["execution_info_count"] = previous_run.get("execution_info_count", 0)
                 print(f"Resuming from page {start_page}")
     
     # Use default OpenRouter config if none provided
@@ -275,9 +511,7 @@ def run_scraper(url: str, result: dict, start_time: datetime, graph_config: Opti
         graph_config = get_graph_config(use_proxy=True)
 
     # Get page count (cached or fresh)
-    last_page, exec_info = get_page_count(url, graph_config)
-    if not execution_info:  # Only append if starting fresh
-        execution_info = [exec_info]
+    last_page, page_count_info = get_page_count(url, graph_config)
     print(f'Found {last_page} total pages')
 
     # Generate all page URLs
@@ -285,45 +519,61 @@ def run_scraper(url: str, result: dict, start_time: datetime, graph_config: Opti
     pages = ListingsPages(pages=[], num_pages=last_page)
     
     # Load existing pages if resuming
-    if start_page > 1 and output_path.exists():
-        with open(output_path, 'r') as f:
-            previous_run = json.load(f)
-            if previous_run["data"]:
-                pages.pages = [ListingsPage(**page) for page in previous_run["data"]["pages"][:start_page-1]]
-    
-    # Scrape each page
-    for page_num in range(start_page, last_page + 1):
-        page_url = f"{base_url}{page_num}.html"
-        print(f'Scraping page {page_num} of {last_page}')
-        
-        try:
-            listing_previews, exec_info = scrape_page(page_url, graph_config)
-            execution_info.append(exec_info)
-            
-            new_page = ListingsPage(
-                page_url=page_url,
-                page_number=page_num,
-                listing_previews=listing_previews
-            )
-            pages.pages.append(new_page)
+    if start_page > 1:
+        resumed = load_finished_pages(pages_path).pages
+        pages.pages = [page for page in resumed if page.page_number < start_page]
+    
+    # Scrape pages concurrently. Pages finish out of order, so finished pages
+    # wait in `finished` until every page before them is done; that keeps
+    # pages in order and last_completed_page safe to resume from. Progress is
+    # only saved from the event loop, so the file never has concurrent writers
+    executor = ThreadPoolExecutor(max_workers=int(os.getenv("SCRAPE_CONCURRENCY", SCRAPE_CONCURRENCY)))
+    tasks = [
+        scrape_page_async(page_num, f"{base_url}{page_num}.html", graph_config, executor)
+        for page_num in range(start_page, last_page + 1)
+    ]
+    finished = {}
+    next_page = start_page
+    # Each page is appended once instead of rewriting every page after each one
+    # Execution info is logged the same way so it never bloats the progress file
+    with executor, \
+            open(pages_path, 'w') as pages_file, \
+            open(execution_info_path, 'ab' if start_page > 1 else 'wb') as info_file:
+        # Rewrite the resumed pages so pages from the failed run past them are dropped
+        for page in pages.pages:
+            pages_file.write(page.model_dump_json() + "\n")
+        if start_page == 1:  # Only log the page count if starting fresh
+            info_file.write(orjson.dumps(page_count_info) + b"\n")
+            result["execution_info_count"] += 1
+        for task in asyncio.as_completed(tasks):
+            page_num, page, exec_info = await task
+            finished[page_num] = page
+            if page:
+                info_file.write(orjson.dumps(exec_info) + b"\n")
+                result["execution_info_count"] += 1
+                # Use prettify_exec_info for better formatting
+                print(prettify_exec_info(exec_info))
+                print(f'done with page {page_num} of {last_page}')
             
-            # Update result data and save progress
-            result["data"] = pages.model_dump()
-            result["last_completed_page"] = page_num
-            save_progress(result, start_time)
+            if page_num != next_page:
+                continue
             
-            # Use prettify_exec_info for better formatting
-            print(prettify_exec_info(exec_info))
-            print('done, next page...')
+            # Failed pages are skipped, as they were when scraping serially
+            while next_page in finished:
+                page = finished.pop(next_page)
+                if page:
+                    pages.pages.append(page)
+                    pages_file.write(page.model_dump_json() + "\n")
+                next_page += 1
+            pages_file.flush()
+            info_file.flush()
             
-        except Exception as e:
-            print(f"Error scraping page {page_num}: {str(e)}")
-            print("Continuing to next page...")
-            continue
+            # Save progress, which now only holds the run's metadata
+            result["last_completed_page"] = next_page - 1
+            save_progress(result, start_time)
 
     return {
-        "result": pages.model_dump(),
-        "execution_info": execution_info
+        "result": pages
     }
 
 def main():
@@ -363,11 +613,10 @@ def main():
     try:
         print(f"Processing URL: {url}")
         # Choose which config to use
-        scrape_result = run_scraper(url, result, start_time, graph_config=default_config)
+        scrape_result = asyncio.run(run_scraper(url, result, start_time, graph_config=default_config))
         
         result["status"] = "completed"
         result["data"] = scrape_result["result"]
-        result["execution_info"] = scrape_result["execution_info"]
         
     except Exception as e:
         print("\nError occurred:")
@@ -379,6 +628,14 @@ def main():
             "traceback": traceback.format_exc()
         }
     finally:
+        # Keep the pages finished before a failure or interrupt in the result,
+        # so parse.py and search_price.py can still read them. Pages past
+        # last_completed_page are left over from an earlier run
+        if result["data"] is None:
+            pages = load_finished_pages()
+            last_completed_page = result["last_completed_page"] or 0
+            pages.pages = [page for page in pages.pages if page.page_number <= last_completed_page]
+            result["data"] = pages
         save_progress(result, start_time)
 
 if __name__ == "__main__":
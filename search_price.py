@@ -6,12 +6,21 @@ from dotenv import load_dotenv
 from scrapegraphai.graphs import SearchGraph
 from scrapegraphai.utils import prettify_exec_info
 import os
-from datetime import datetime
-from statistics import mean, median
-from pymongo import MongoClient
+from datetime import datetime, timedelta
+from pymongo import UpdateOne
 from pymongo.collection import Collection
 from pymongo.database import Database
 import hashlib
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from database import BulkWriter, _get_client
+import numpy as np
+from openai import OpenAI
+
+EMBEDDING_MODEL = "text-embedding-3-small"  # Model used to embed gun names for the semantic cache
+SEMANTIC_MATCH_THRESHOLD = 0.92  # Minimum cosine similarity to reuse another gun's market price
+PRICE_SEARCH_WORKERS = 16  # Market price searches run at once
 
 class GunListing(BaseModel):
     """Individual gun listing from a dealer/marketplace"""
@@ -28,24 +37,44 @@ class GunPriceSearch(BaseModel):
     model: str = Field(description="Model of the firearm")
     caliber: Optional[str] = Field(description="Caliber of the firearm if specified")
     listings: List[GunListing] = Field(description="List of found listings")
-    last_updated: str = Field(description="When this price data was last updated")
+    last_updated: datetime = Field(description="When this price data was last updated")
     gun_hash: str = Field(description="Unique identifier for this gun model")
 
+    @property
+    def in_stock_prices(self) -> np.ndarray:
+        """Prices of in-stock listings for the price statistics"""
+        return np.fromiter(
+            (l.price for l in self.listings if l.in_stock and l.price > 0), dtype=np.float64
+        )
+
     @property
     def average_price(self) -> float:
         """Calculate average price from in-stock listings"""
-        prices = [l.price for l in self.listings if l.in_stock and l.price > 0]
-        return mean(prices) if prices else 0
+        prices = self.in_stock_prices
+        return float(prices.mean()) if prices.size else 0
 
     @property
     def median_price(self) -> float:
         """Calculate median price from in-stock listings"""
-        prices = [l.price for l in self.listings if l.in_stock and l.price > 0]
-        return median(prices) if prices else 0
+        prices = self.in_stock_prices
+        return float(np.median(prices)) if prices.size else 0
+
+@lru_cache(maxsize=4096)
+def _gun_hash(manufacturer: str, model: str, caliber: Optional[str]) -> str:
+    """Hash a gun model, memoized since the same guns repeat across listings"""
+    # Normalize strings
+    manufacturer = manufacturer.lower().strip()
+    model = model.lower().strip()
+    caliber = caliber.lower().strip() if caliber and caliber != "NA" else ""
+    
+    # Create hash
+    hash_string = f"{manufacturer}|{model}|{caliber}"
+    return hashlib.md5(hash_string.encode()).hexdigest()
 
 class MongoManager:
     def __init__(self):
-        self.client = MongoClient(os.getenv("MONGODB_URI", "mongodb://localhost:27017/"))
+        # One shared client per URI; its 50 connection pool covers every search thread
+        self.client = _get_client(os.getenv("MONGODB_URI", "mongodb://localhost:27017/"))
         self.db: Database = self.client.gun_market_data
         self.scraped_listings: Collection = self.db.scraped_listings
         self.market_prices: Collection = self.db.market_prices
@@ -54,44 +83,101 @@ class MongoManager:
         # Create indexes
         self.market_prices.create_index("gun_hash", unique=True)
         self.scraped_listings.create_index("listing_url", unique=True)
+        self.scraped_listings.create_index([("guns.manufacturer", 1), ("guns.model", 1)])
         self.price_analyses.create_index([
             ("gun_hash", 1),
             ("listing_url", 1)
         ], unique=True)
+        
+        # Embeddings of fresh market prices, loaded on the first semantic lookup
+        # and kept for the rest of the run instead of re-read on every miss
+        self._embedding_lock = threading.Lock()
+        self._embedding_hashes: Optional[List[str]] = None
+        self._embedding_matrix: Optional[np.ndarray] = None
 
     def generate_gun_hash(self, manufacturer: str, model: str, caliber: Optional[str] = None) -> str:
         """Generate a unique hash for a gun model"""
-        # Normalize strings
-        manufacturer = manufacturer.lower().strip()
-        model = model.lower().strip()
-        caliber = caliber.lower().strip() if caliber and caliber != "NA" else ""
-        
-        # Create hash
-        hash_string = f"{manufacturer}|{model}|{caliber}"
-        return hashlib.md5(hash_string.encode()).hexdigest()
+        return _gun_hash(manufacturer, model, caliber)
 
     def save_scraped_listings(self, listings_data: dict):
         """Save scraped listings to MongoDB"""
+        writer = BulkWriter(self.scraped_listings)
         for page in listings_data["data"]["pages"]:
             if not page.get("listing_previews"):
                 continue
                 
             for listing in page["listing_previews"]["listings"]:
                 listing["_id"] = listing["listing_url"]  # Use listing URL as unique ID
-                self.scraped_listings.update_one(
+                writer.add(UpdateOne(
                     {"_id": listing["_id"]},
                     {"$set": listing},
                     upsert=True
-                )
+                ))
+        writer.flush()
 
     def get_market_price(self, gun_hash: str) -> Optional[dict]:
         """Get existing market price data if not too old"""
-        price_data = self.market_prices.find_one({"gun_hash": gun_hash})
-        if price_data:
-            last_updated = datetime.fromisoformat(price_data["last_updated"])
-            if (datetime.now() - last_updated).days < 7:  # Cache for 7 days
-                return price_data
-        return None
+        return self.market_prices.find_one({
+            "gun_hash": gun_hash,
+            "last_updated": {"$gte": datetime.utcnow() - timedelta(days=7)}  # Cache for 7 days
+        })
+
+    def _load_embeddings(self):
+        """Read the embeddings of all fresh market prices into one matrix"""
+        docs = list(self.market_prices.find(
+            {
+                "embedding": {"$exists": True},
+                "last_updated": {"$gte": datetime.utcnow() - timedelta(days=7)}
+            },
+            {"_id": 0, "gun_hash": 1, "embedding": 1}
+        ))
+        self._embedding_hashes = [d["gun_hash"] for d in docs]
+        self._embedding_matrix = np.array([d["embedding"] for d in docs], dtype=np.float32)
+
+    def get_semantic_price(self, embedding: List[float]) -> Optional[dict]:
+        """Get fresh market price data for the most similar gun name, if similar enough"""
+        with self._embedding_lock:
+            if self._embedding_matrix is None:
+                self._load_embeddings()
+            # save_market_price replaces rather than mutates these, so they can be used unlocked
+            hashes, matrix = self._embedding_hashes, self._embedding_matrix
+        if not hashes:
+            return None
+        
+        # Embeddings from OpenAI are unit length, so the dot product is the cosine similarity
+        scores = matrix @ np.asarray(embedding, dtype=np.float32)
+        best = int(scores.argmax())
+        if scores[best] < SEMANTIC_MATCH_THRESHOLD:
+            return None
+        return self.get_market_price(hashes[best])
+
+    def save_market_price(self, result: GunPriceSearch, embedding: Optional[List[float]] = None):
+        """Upsert a gun's market price, adding its embedding to the semantic cache"""
+        price_doc = result.dict()
+        if embedding:
+            price_doc["embedding"] = embedding
+        self.market_prices.update_one(
+            {"gun_hash": result.gun_hash},
+            {"$set": price_doc},
+            upsert=True
+        )
+        
+        if embedding:
+            with self._embedding_lock:
+                if self._embedding_matrix is not None:
+                    vector = np.asarray([embedding], dtype=np.float32)
+                    matrix = self._embedding_matrix
+                    self._embedding_matrix = np.vstack([matrix, vector]) if len(matrix) else vector
+                    self._embedding_hashes = self._embedding_hashes + [result.gun_hash]
+
+def gun_search_text(gun: dict) -> str:
+    """Normalized gun name that gets embedded for the semantic cache"""
+    parts = [gun["manufacturer"], gun["model"], gun.get("caliber")]
+    return " ".join(p.lower().strip() for p in parts if p and p != "NA")
+
+def embed_text(client: OpenAI, text: str) -> List[float]:
+    """Embed text with the semantic cache's embedding model"""
+    return client.embeddings.create(model=EMBEDDING_MODEL, input=text).data[0].embedding
 
 def create_search_prompt(gun) -> str:
     """Create a search prompt for a specific gun"""
@@ -115,7 +201,12 @@ def create_search_prompt(gun) -> str:
     """
     return prompt
 
-def search_market_price(gun: dict, config: dict, db: MongoManager) -> GunPriceSearch:
+def search_market_price(
+    gun: dict,
+    config: dict,
+    db: MongoManager,
+    embeddings_client: Optional[OpenAI] = None
+) -> GunPriceSearch:
     """Search for market prices of a specific gun"""
     gun_hash = db.generate_gun_hash(gun["manufacturer"], gun["model"], gun["caliber"])
     
@@ -124,6 +215,25 @@ def search_market_price(gun: dict, config: dict, db: MongoManager) -> GunPriceSe
     if cached_data:
         return GunPriceSearch(**cached_data)
     
+    # Then reuse prices of a differently written name for the same gun
+    # ("Glock 19" vs "GLOCK 19 Gen5")
+    embedding = None
+    if embeddings_client:
+        embedding = embed_text(embeddings_client, gun_search_text(gun))
+        cached_data = db.get_semantic_price(embedding)
+        if cached_data:
+            print(f"Using market price of {cached_data['manufacturer']} {cached_data['model']}")
+            # Store a copy under this gun's own hash so its analyses and the
+            # next exact lookup find it
+            result = GunPriceSearch(**cached_data).model_copy(update={
+                "manufacturer": gun["manufacturer"],
+                "model": gun["model"],
+                "caliber": gun["caliber"],
+                "gun_hash": gun_hash
+            })
+            db.save_market_price(result, embedding)
+            return result
+    
     # If no cache, perform search
     search_graph = SearchGraph(
         prompt=create_search_prompt(gun),
@@ -133,33 +243,40 @@ def search_market_price(gun: dict, config: dict, db: MongoManager) -> GunPriceSe
     
     result = search_graph.run()
     result.gun_hash = gun_hash
-    result.last_updated = datetime.now().isoformat()
+    result.last_updated = datetime.utcnow()
     
     # Save to database
-    db.market_prices.update_one(
-        {"gun_hash": gun_hash},
-        {"$set": result.dict()},
-        upsert=True
-    )
+    db.save_market_price(result, embedding)
     
     return result
 
+def analyze_listing_prices(listing_prices: List[float], market_data: List[GunPriceSearch]) -> List[dict]:
+    """Analyze how each listing price compares to its gun's market prices, in one vectorized pass"""
+    prices = np.asarray(listing_prices, dtype=np.float64)
+    medians = np.array([m.median_price for m in market_data], dtype=np.float64)
+    averages = np.array([m.average_price for m in market_data], dtype=np.float64)
+    
+    has_data = averages != 0
+    price_diff = prices - medians
+    # Guns without market data get a placeholder divisor; their results are replaced below
+    price_diff_pct = price_diff / np.where(has_data, medians, 1) * 100
+    status = np.where(price_diff_pct > 10, "overpriced", np.where(price_diff_pct < -10, "underpriced", "fair_price"))
+    
+    return [
+        {
+            "listing_price": listing_prices[i],
+            "market_median": float(medians[i]),
+            "market_average": float(averages[i]),
+            "price_difference": float(price_diff[i]),
+            "price_difference_percent": float(price_diff_pct[i]),
+            "status": str(status[i])
+        } if has_data[i] else {"status": "no_data", "message": "No market data available"}
+        for i in range(len(listing_prices))
+    ]
+
 def analyze_listing_price(listing_price: float, market_data: GunPriceSearch) -> dict:
     """Analyze how a listing price compares to market prices"""
-    if market_data.average_price == 0:
-        return {"status": "no_data", "message": "No market data available"}
-    
-    price_diff = listing_price - market_data.median_price
-    price_diff_pct = (price_diff / market_data.median_price) * 100
-    
-    return {
-        "listing_price": listing_price,
-        "market_median": market_data.median_price,
-        "market_average": market_data.average_price,
-        "price_difference": price_diff,
-        "price_difference_percent": price_diff_pct,
-        "status": "overpriced" if price_diff_pct > 10 else "underpriced" if price_diff_pct < -10 else "fair_price"
-    }
+    return analyze_listing_prices([listing_price], [market_data])[0]
 
 def main():
     load_dotenv()
@@ -178,51 +295,88 @@ def main():
     # Initialize MongoDB connection
     db = MongoManager()
     
+    # The semantic price cache needs an OpenAI key for embeddings
+    embeddings_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY")) if os.getenv("OPENAI_API_KEY") else None
+    
     # Load and save scraped listings
     with open("scraping_results.json", 'r') as f:
         data = json.load(f)
     db.save_scraped_listings(data)
     
-    # Process each listing with guns
-    for listing in db.scraped_listings.find():
-        if not listing.get("guns"):
-            continue
-            
-        for gun in listing["guns"]:
-            if gun["manufacturer"] == "NA" or gun["model"] == "NA":
-                continue
-                
-            print(f"\nAnalyzing: {gun['manufacturer']} {gun['model']}")
-            
+    # Process each listing with guns, queueing analyses for bulk writes
+    analyses_writer = BulkWriter(db.price_analyses)
+    # Only listings with a known gun are fetched, with their guns filtered down
+    # to the known ones and only the fields the analysis reads
+    unknown = ["NA", None]
+    listings_with_guns = db.scraped_listings.find(
+        {"guns": {"$elemMatch": {"manufacturer": {"$nin": unknown}, "model": {"$nin": unknown}}}},
+        {
+            "guns": {"$filter": {
+                "input": "$guns",
+                "cond": {"$and": [
+                    {"$not": [{"$in": [{"$ifNull": ["$$this.manufacturer", None]}, unknown]}]},
+                    {"$not": [{"$in": [{"$ifNull": ["$$this.model", None]}, unknown]}]}
+                ]}
+            }},
+            "price": 1,
+            "listing_url": 1
+        }
+    )
+    gun_jobs = [(listing, gun) for listing in listings_with_guns for gun in listing["guns"]]
+    
+    # Search market prices concurrently, once per distinct gun, since the
+    # searches are independent and spend their time waiting on the network
+    with ThreadPoolExecutor(max_workers=PRICE_SEARCH_WORKERS) as executor:
+        searches = {}
+        for listing, gun in gun_jobs:
+            gun_hash = db.generate_gun_hash(gun["manufacturer"], gun["model"], gun.get("caliber"))
+            if gun_hash not in searches:
+                searches[gun_hash] = executor.submit(search_market_price, gun, graph_config, db, embeddings_client)
+        
+        # Wait for every search, then analyze all listing prices at once
+        searched = []
+        for listing, gun in gun_jobs:
+            gun_hash = db.generate_gun_hash(gun["manufacturer"], gun["model"], gun.get("caliber"))
             try:
-                # Get or fetch market data
-                market_data = search_market_price(gun, graph_config, db)
-                analysis = analyze_listing_price(listing["price"], market_data)
-                
-                # Save analysis
-                analysis_doc = {
-                    "gun_hash": market_data.gun_hash,
-                    "listing_url": listing["listing_url"],
-                    "analysis": analysis,
-                    "timestamp": datetime.now().isoformat()
-                }
-                
-                db.price_analyses.update_one(
-                    {
-                        "gun_hash": market_data.gun_hash,
-                        "listing_url": listing["listing_url"]
-                    },
-                    {"$set": analysis_doc},
-                    upsert=True
-                )
-                
-                print(f"Status: {analysis['status']}")
-                print(f"Market median: ${analysis['market_median']:,.2f}")
-                print(f"Listing price: ${analysis['listing_price']:,.2f}")
-                print(f"Difference: {analysis['price_difference_percent']:.1f}%")
-                
+                searched.append((listing, gun, searches[gun_hash].result()))
             except Exception as e:
                 print(f"Error processing {gun['manufacturer']} {gun['model']}: {str(e)}")
+    
+    analyses = analyze_listing_prices(
+        [listing["price"] for listing, _, _ in searched],
+        [market_data for _, _, market_data in searched]
+    )
+    
+    for (listing, gun, market_data), analysis in zip(searched, analyses):
+        print(f"\nAnalyzing: {gun['manufacturer']} {gun['model']}")
+        
+        try:
+            # Save analysis
+            analysis_doc = {
+                "gun_hash": market_data.gun_hash,
+                "listing_url": listing["listing_url"],
+                "analysis": analysis,
+                "timestamp": datetime.now().isoformat()
+            }
+            
+            analyses_writer.add(UpdateOne(
+                {
+                    "gun_hash": market_data.gun_hash,
+                    "listing_url": listing["listing_url"]
+                },
+                {"$set": analysis_doc},
+                upsert=True
+            ))
+            
+            print(f"Status: {analysis['status']}")
+            print(f"Market median: ${analysis['market_median']:,.2f}")
+            print(f"Listing price: ${analysis['listing_price']:,.2f}")
+            print(f"Difference: {analysis['price_difference_percent']:.1f}%")
+            
+        except Exception as e:
+            print(f"Error processing {gun['manufacturer']} {gun['model']}: {str(e)}")
+    
+    analyses_writer.flush()
 
 if __name__ == "__main__":
     main()